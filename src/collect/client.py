@@ -0,0 +1,246 @@
+import email.utils
+import os
+import random
+import threading
+import time
+import typing
+
+import requests
+import requests.adapters
+
+# Requests per second allowed for each provider, see <PROVIDER>_RATE_LIMIT
+PROVIDERS = {
+    "harmonic": {"rate": 5.0, "burst": 5},
+    "predictleads": {"rate": 5.0, "burst": 10},
+    "similarweb": {"rate": 10.0, "burst": 10},
+    "peopledatalabs": {"rate": 1.0, "burst": 5},
+    "github": {"rate": 1.35, "burst": 20},
+}
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+class RateLimitError(Exception):
+    pass
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket refilled at `rate` tokens per second
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self.blocked_until = 0.0
+        self.lock = threading.Lock()
+
+    def _refill(self, now: float):
+        self.tokens = min(
+            self.capacity, self.tokens + (now - self.updated_at) * self.rate
+        )
+        self.updated_at = now
+
+    def acquire(self, tokens: float = 1):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self._refill(now)
+
+                if now >= self.blocked_until and self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return
+
+                wait = max(
+                    self.blocked_until - now, (tokens - self.tokens) / self.rate
+                )
+
+            time.sleep(wait)
+
+    def pause(self, seconds: float):
+        """
+        Block every caller for `seconds`, used when the provider tells us to back off
+        """
+        with self.lock:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+            self.tokens = 0
+
+
+def parse_retry_after(response: requests.Response) -> typing.Optional[float]:
+    """
+    Return the delay requested by the provider in seconds, if any
+    """
+    value = response.headers.get("Retry-After")
+
+    if value:
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            pass
+
+        try:
+            retry_at = email.utils.parsedate_to_datetime(value)
+            return max(0.0, retry_at.timestamp() - time.time())
+        except (TypeError, ValueError):
+            pass
+
+    remaining = response.headers.get(
+        "X-RateLimit-Remaining", response.headers.get("RateLimit-Remaining")
+    )
+    reset = response.headers.get(
+        "X-RateLimit-Reset", response.headers.get("RateLimit-Reset")
+    )
+
+    if remaining is None or reset is None:
+        return None
+
+    try:
+        remaining = float(remaining)
+        reset = float(reset)
+    except ValueError:
+        return None
+
+    if remaining > 0:
+        return None
+
+    # Reset is either an epoch timestamp (GitHub style) or a delay in seconds
+    if reset > 1_000_000_000:
+        reset = reset - time.time()
+
+    return max(0.0, reset)
+
+
+class ProviderClient:
+    """
+    Pooled HTTP client shared by the collectors of a single provider
+
+    Every request goes through the provider token bucket, rate limit headers pause
+    the bucket for everyone and failed requests are retried with jittered
+    exponential backoff.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        rate: float,
+        burst: float,
+        max_retries: int = 5,
+        backoff: float = 1.0,
+        max_backoff: float = 60.0,
+        timeout: float = 60.0,
+        pool_size: int = 10,
+    ):
+        self.name = name
+        self.bucket = TokenBucket(rate, burst)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        self.in_flight = threading.BoundedSemaphore(pool_size)
+
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=4, pool_maxsize=pool_size
+        )
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def backoff_delay(self, attempt: int) -> float:
+        # Full jitter: uniform between 0 and the exponential ceiling
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2**attempt))
+
+    def request(self, method: str, url: str, **kwargs) -> requests.Response:
+        kwargs.setdefault("timeout", self.timeout)
+
+        for attempt in range(self.max_retries + 1):
+            self.bucket.acquire()
+
+            try:
+                with self.in_flight:
+                    response = self.session.request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if attempt == self.max_retries:
+                    raise
+
+                delay = self.backoff_delay(attempt)
+                print(f"{self.name}: {e}, retrying in {delay:.1f}s")
+                time.sleep(delay)
+                continue
+
+            retry_after = parse_retry_after(response)
+
+            if retry_after and response.status_code < 400:
+                # Quota exhausted but this request went through, slow down the others
+                self.bucket.pause(retry_after)
+
+            # Some providers (GitHub) answer 403 with an exhausted quota header
+            rate_limited = response.status_code == 429 or (
+                response.status_code == 403 and retry_after is not None
+            )
+
+            if response.status_code not in RETRY_STATUSES and not rate_limited:
+                return response
+
+            if attempt == self.max_retries:
+                if rate_limited:
+                    raise RateLimitError(
+                        f"{self.name}: rate limit error, max retries reached"
+                    )
+                return response
+
+            delay = retry_after
+            if delay is None:
+                delay = self.backoff_delay(attempt)
+
+            if rate_limited:
+                self.bucket.pause(delay)
+
+            print(
+                f"{self.name}: {response.status_code}, retrying in {delay:.1f}s "
+                f"({attempt + 1}/{self.max_retries})"
+            )
+            time.sleep(delay)
+
+        return response
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url: str, **kwargs) -> requests.Response:
+        return self.request("POST", url, **kwargs)
+
+    def get_json(self, url: str, **kwargs) -> typing.Optional[typing.Any]:
+        """
+        GET a JSON document, returns None when the provider answers with an error
+        """
+        response = self.get(url, **kwargs)
+
+        if response.status_code >= 400:
+            print("Error:", response.status_code, response.text[:200])
+            return None
+
+        return response.json()
+
+
+clients: typing.Dict[str, ProviderClient] = {}
+clients_lock = threading.Lock()
+
+
+def get_client(provider: str, **kwargs) -> ProviderClient:
+    """
+    Return the shared client of a provider, created on first use
+    """
+    with clients_lock:
+        if provider not in clients:
+            config = dict(PROVIDERS.get(provider, {"rate": 1.0, "burst": 1}))
+
+            rate = os.environ.get(f"{provider.upper()}_RATE_LIMIT")
+            if rate:
+                config["rate"] = float(rate)
+
+            config.update(kwargs)
+            clients[provider] = ProviderClient(provider, **config)
+
+        return clients[provider]
@@ -0,0 +1,257 @@
+import os
+import threading
+import typing
+
+from src.collect.client import get_client
+from src.utils.state import StateFile
+
+GRAPHQL_URL = "https://api.github.com/graphql"
+REST_URL = "https://api.github.com"
+
+# Owners fetched by a single GraphQL query
+BATCH_SIZE = int(os.environ.get("GITHUB_GRAPHQL_BATCH_SIZE", 20))
+
+# Repositories kept per owner, by stars
+TOP_REPOSITORIES = int(os.environ.get("GITHUB_TOP_REPOSITORIES", 3))
+
+# Follower counts are not in GraphQL, each organization costs a conditional REST
+# call (REST quota, not GraphQL). Disabled, stored follower counts are kept.
+FETCH_FOLLOWERS = os.environ.get("GITHUB_FETCH_FOLLOWERS", "true").lower() in (
+    "1",
+    "true",
+    "yes",
+)
+
+README_PATHS = ["README.md", "readme.md", "README.rst", "README", "README.txt"]
+
+etags = StateFile(os.environ.get("GITHUB_ETAG_FILE", ".state/github_etags.json"))
+
+# ETags seen since the last save, written in one go by save_etags
+pending_etags: typing.Dict[str, dict] = {}
+pending_etags_lock = threading.Lock()
+
+REPOSITORY_FIELDS = """
+    databaseId
+    nameWithOwner
+    name
+    url
+    description
+    isFork
+    pushedAt
+    homepageUrl
+    diskUsage
+    stargazerCount
+    forkCount
+    primaryLanguage { name }
+    isArchived
+    isDisabled
+    licenseInfo { key name url }
+    repositoryTopics(first: 20) { nodes { topic { name } } }
+"""
+
+
+def headers() -> dict:
+    return {"Authorization": f"bearer {os.environ.get('GITHUB_API_KEY')}"}
+
+
+def build_query(count: int) -> str:
+    """
+    One aliased repositoryOwner field per owner, logins are passed as variables
+    """
+    readmes = "\n".join(
+        f'readme{i}: object(expression: "HEAD:{path}") {{ ... on Blob {{ text }} }}'
+        for i, path in enumerate(README_PATHS)
+    )
+
+    owners = "\n".join(
+        f"""
+        owner{i}: repositoryOwner(login: $login{i}) {{
+            __typename
+            login
+            ... on Organization {{ databaseId name websiteUrl }}
+            repositories(
+                first: {TOP_REPOSITORIES}
+                ownerAffiliations: OWNER
+                orderBy: {{ field: STARGAZERS, direction: DESC }}
+            ) {{
+                nodes {{
+                    {REPOSITORY_FIELDS}
+                    {readmes}
+                }}
+            }}
+        }}
+        """
+        for i in range(count)
+    )
+
+    variables = ", ".join(f"$login{i}: String!" for i in range(count))
+    return f"query({variables}) {{ {owners} }}"
+
+
+def get_followers(login: str) -> typing.Optional[int]:
+    """
+    Follower count of an organization (not exposed by GraphQL). The request is
+    conditional on the last ETag, unchanged organizations answer 304 without
+    using the rate limit.
+    """
+    cached = etags.get(login)
+    request_headers = headers()
+
+    if cached:
+        request_headers["If-None-Match"] = cached["etag"]
+
+    response = get_client("github").get(
+        f"{REST_URL}/orgs/{login}", headers=request_headers
+    )
+
+    if response.status_code == 304 and cached:
+        return cached["followers"]
+
+    if response.status_code >= 400:
+        print("Error:", response.status_code, response.text[:200])
+        return None
+
+    followers = response.json().get("followers")
+
+    if response.headers.get("ETag"):
+        with pending_etags_lock:
+            pending_etags[login] = {
+                "etag": response.headers["ETag"],
+                "followers": followers,
+            }
+
+    return followers
+
+
+def save_etags():
+    with pending_etags_lock:
+        values = dict(pending_etags)
+        pending_etags.clear()
+
+    etags.update(values)
+
+
+def parse_repository(repo: dict, organization_id: int) -> dict:
+    license = repo.get("licenseInfo") or {}
+
+    readme = next(
+        (
+            repo[f"readme{i}"]["text"]
+            for i in range(len(README_PATHS))
+            if (repo.get(f"readme{i}") or {}).get("text")
+        ),
+        None,
+    )
+
+    return {
+        "id": repo.get("databaseId"),
+        "full_name": repo.get("nameWithOwner"),
+        "name": repo.get("name"),
+        "url": repo.get("url"),
+        "description": repo.get("description"),
+        "readme": readme,
+        "fork": repo.get("isFork"),
+        "pushed_at": repo.get("pushedAt"),
+        "homepage_url": repo.get("homepageUrl"),
+        "size": repo.get("diskUsage"),
+        "stargazers_count": repo.get("stargazerCount"),
+        # REST watchers_count is the stargazer count, not the subscribers
+        "watchers_count": repo.get("stargazerCount"),
+        "forks_count": repo.get("forkCount"),
+        "language": (repo.get("primaryLanguage") or {}).get("name"),
+        "archived": repo.get("isArchived"),
+        "disabled": repo.get("isDisabled"),
+        "license_key": license.get("key"),
+        "license_name": license.get("name"),
+        "license_url": license.get("url"),
+        "topics": [
+            node["topic"]["name"]
+            for node in (repo.get("repositoryTopics") or {}).get("nodes", [])
+        ],
+        "organization_id": organization_id,
+    }
+
+
+def fetch_batch(
+    owners: typing.List[str],
+) -> typing.Optional[
+    typing.Dict[str, typing.Tuple[typing.Optional[dict], typing.List[dict]]]
+]:
+    """
+    One GraphQL query for up to BATCH_SIZE owners, None when it failed
+    """
+    response = get_client("github").post(
+        GRAPHQL_URL,
+        headers=headers(),
+        json={
+            "query": build_query(len(owners)),
+            "variables": {f"login{i}": owner for i, owner in enumerate(owners)},
+        },
+    )
+
+    if response.status_code >= 400:
+        print("Error:", response.status_code, response.text[:200])
+        return None
+
+    payload = response.json()
+    data = payload.get("data") or {}
+
+    # Unknown owners come back as null with a NOT_FOUND error, any other error
+    # fails the whole query so its owners are not mistaken for unknown ones
+    errors = [
+        error for error in payload.get("errors", []) if error.get("type") != "NOT_FOUND"
+    ]
+
+    if errors:
+        print(f"GraphQL error: {errors[0].get('message')}")
+        return None
+
+    results = {}
+
+    for i, owner in enumerate(owners):
+        node = data.get(f"owner{i}")
+
+        # Only organizations are enriched, like the REST get_organization lookup
+        if not node or node.get("__typename") != "Organization":
+            results[owner] = (None, [])
+            continue
+
+        organization = {
+            "name": node.get("name"),
+            "url": f"{REST_URL}/orgs/{node['login']}",
+            "homepage_url": node.get("websiteUrl"),
+            "id": node.get("databaseId"),
+        }
+
+        if FETCH_FOLLOWERS:
+            organization["followers"] = get_followers(node["login"])
+
+        repositories = [
+            parse_repository(repo, node.get("databaseId"))
+            for repo in (node.get("repositories") or {}).get("nodes", [])
+            if repo
+        ]
+
+        results[owner] = (organization, repositories)
+
+    return results
+
+
+def fetch_owners(
+    owners: typing.List[str],
+) -> typing.Dict[str, typing.Tuple[typing.Optional[dict], typing.List[dict]]]:
+    """
+    Fetch the organization, its top repositories and their READMEs for every
+    owner, BATCH_SIZE owners per GraphQL query. Callers gather the owners of
+    several companies so the queries are full.
+
+    :return: Owner to (organization, repositories), organization is None for
+        users and unknown owners. Owners of a failed query are left out.
+        Organizations have no company_id yet.
+    """
+    results = {}
+
+    for i in range(0, len(owners), BATCH_SIZE):
+        results.update(fetch_batch(owners[i : i + BATCH_SIZE]) or {})
+
+    return results
@@ -1,56 +1,130 @@
+import concurrent.futures
 import os
+import queue
+import threading
 import typing
 
-import pandas as pd
-import requests
-import sqlalchemy
-
 import src.utils as utils
+from src.collect.client import get_client
+from src.utils.bulk_copy import copy_upsert_harmonic_data
+from src.utils.bulk_upsert import bulk_upsert
+from src.utils.state import StateFile
 
 db = utils.db
 
 BASE_URL = "https://api.harmonic.ai"
 
+# Pages fetched ahead while the previous ones are written (0 = fetch and write in turn)
+PREFETCH_PAGES = int(os.environ.get("HARMONIC_PREFETCH_PAGES", 2))
+
+# Comma separated saved searches, each one is crawled with its own cursor
+SAVED_SEARCH_IDS = [
+    search_id.strip()
+    for search_id in os.environ.get("HARMONIC_SAVED_SEARCH_IDS", "129627").split(",")
+    if search_id.strip()
+]
+
+# Number of saved searches crawled at the same time
+CONCURRENCY = int(os.environ.get("HARMONIC_CONCURRENCY", len(SAVED_SEARCH_IDS)))
+
+# Restart unfinished crawls from their last checkpoint instead of page 1
+RESUME = os.environ.get("HARMONIC_RESUME", "false").lower() in ("1", "true", "yes")
 
-def get_companies(cursor: typing.Optional[str] = None):
+checkpoints = StateFile(
+    os.environ.get("HARMONIC_STATE_FILE", ".state/harmonic_checkpoints.json")
+)
+
+
+def get_companies(search_id: str, cursor: typing.Optional[str] = None):
     headers = {"apikey": os.environ.get("HARMONIC_API_KEY")}
 
-    URL = f"{BASE_URL}/savedSearches:results/129627?size=100"
+    URL = f"{BASE_URL}/savedSearches:results/{search_id}?size=100"
 
     if cursor:
         URL = f"{URL}&cursor={cursor}"
 
-    response = requests.get(URL, headers=headers)
+    return get_client("harmonic").get_json(URL, headers=headers)
+
 
-    if response.status_code >= 400:
-        print("Error:", response.status_code)
-        return
+def fetch_pages(
+    search_id: str, cursor: str = "", page: int = 0
+) -> typing.Iterator[typing.Tuple[int, dict]]:
+    """
+    Walk the saved search cursor and yield (page number, page data)
+    """
+    while True:
+        page += 1
 
-    data = response.json()
-    return data
+        print(f"[{search_id}] Page: {page}")
+        data = get_companies(search_id, cursor)
 
+        if not data:
+            # Retries are exhausted, asking for the same cursor again would loop forever
+            print(f"[{search_id}] Could not fetch page {page}, stopping")
+            return
 
-done: bool = False
-cursor: str = ""
-page = 0
+        yield page, data
 
-while not done:
-    page += 1
+        if not data.get("page_info", {}).get("has_next", False):
+            return
 
-    print(f"Page: {page}")
-    data = get_companies(cursor)
+        cursor = data.get("page_info", {}).get("next", "")
 
-    if not data:
-        continue
 
-    cursor = data.get("page_info", {}).get("next", "")
-    has_next = data.get("page_info", {}).get("has_next", False)
+def prefetch(items: typing.Iterator, size: int) -> typing.Iterator:
+    """
+    Consume `items` on a background thread, keeping at most `size` items buffered
+    """
+    buffer: queue.Queue = queue.Queue(maxsize=size)
+    stop = threading.Event()
+    done = object()
+
+    def put(item) -> bool:
+        while not stop.is_set():
+            try:
+                buffer.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in items:
+                if not put(item):
+                    return
+        except Exception as e:
+            put(e)
+        finally:
+            put(done)
+
+    producer = threading.Thread(target=produce, daemon=True)
+    producer.start()
 
-    if not has_next:
-        done = True
+    try:
+        while True:
+            item = buffer.get()
 
+            if item is done:
+                return
+
+            if isinstance(item, Exception):
+                raise item
+
+            yield item
+    finally:
+        # Unblock the producer when the consumer stops early
+        stop.set()
+        producer.join()
+
+
+def parse_page(data: dict) -> typing.Tuple[typing.List[dict], typing.List[dict]]:
+    """
+    Turn a page of results into company rows and traction metric data points
+    """
     results = data.get("results", [])
     companies = []
+    data_points = []
 
     for result in results:
         founded_at = None
@@ -106,15 +180,13 @@ while not done:
 
         companies.append(company)
 
-        data = []
-
         for key in result.get("traction_metrics", {}).keys():
             timeseries = (
                 result.get("traction_metrics", {}).get(key, {}).get("metrics", [])
             )
 
             for item in timeseries:
-                data.append(
+                data_points.append(
                     {
                         "company_id": result.get("id"),
                         "type": key,
@@ -124,59 +196,99 @@ while not done:
                     }
                 )
 
+    return companies, data_points
+
+
+def upsert_companies(companies: typing.List[dict]) -> bool:
     if len(companies) > 0:
         print(f"Upserting {len(companies)} companies")
-        upsert_batch = sqlalchemy.dialects.postgresql.insert(
-            db.schema.classes.companies
-        ).values(companies)
-        upsert_batch = upsert_batch.on_conflict_do_update(
-            index_elements=["id"],
-            set_={
-                key: getattr(upsert_batch.excluded, key) for key in companies[0].keys()
-            },
-        )
-
+        # Saved searches are written from several threads, every batch is
+        # committed on its own connection
         try:
-            db.session.execute(upsert_batch)
-            db.session.commit()
-            companies = []
+            bulk_upsert("companies", companies)
         except Exception as e:
             print(e)
-            db.session.rollback()
-            break
+            return False
 
+    return True
+
+
+def upsert_data_points(data: typing.List[dict]) -> bool:
     if len(data) > 0:
         print(f"Upserting {len(data)} data points")
-        data = pd.DataFrame(data)
-        data = data.drop_duplicates(
-            subset=["company_id", "type", "date", "source"], keep="first"
+
+        try:
+            copy_upsert_harmonic_data(data)
+        except Exception as e:
+            print(e)
+            return False
+
+    return True
+
+
+def crawl(search_id: str) -> bool:
+    """
+    Crawl a saved search, checkpointing the cursor after every written page
+    """
+    checkpoint = checkpoints.get(search_id)
+
+    cursor = ""
+    page = 0
+
+    if RESUME and checkpoint and not checkpoint.get("done"):
+        cursor = checkpoint.get("cursor", "")
+        page = checkpoint.get("page", 0)
+        print(f"[{search_id}] Resuming after page {page}")
+
+    pages = fetch_pages(search_id, cursor, page)
+
+    # The next pages download while the current one is parsed and written
+    if PREFETCH_PAGES > 0:
+        pages = prefetch(pages, PREFETCH_PAGES)
+
+    done = False
+
+    for page, data in pages:
+        companies, data_points = parse_page(data)
+
+        if not upsert_companies(companies):
+            return False
+
+        if not upsert_data_points(data_points):
+            return False
+
+        page_info = data.get("page_info", {})
+        done = not page_info.get("has_next", False)
+
+        checkpoints.set(
+            search_id,
+            {"cursor": page_info.get("next", ""), "page": page, "done": done},
         )
-        data = data.dropna()
-        data = data.to_dict(orient="records")
-
-        BATCH_SIZE = 5_000
-        batch_count = len(data) // BATCH_SIZE + 1
-
-        for i in range(batch_count):
-            print(f"Batch {i + 1}/{batch_count}")
-            batch = data[i * BATCH_SIZE : (i + 1) * BATCH_SIZE]
-
-            upsert_batch = sqlalchemy.dialects.postgresql.insert(
-                db.schema.classes.harmonic_data
-            ).values(batch)
-            upsert_batch = upsert_batch.on_conflict_do_update(
-                index_elements=["company_id", "type", "date", "source"],
-                set_={
-                    key: getattr(upsert_batch.excluded, key) for key in batch[0].keys()
-                },
-            )
+
+    return done
+
+
+def main():
+    with concurrent.futures.ThreadPoolExecutor(max_workers=CONCURRENCY) as executor:
+        futures = {
+            executor.submit(crawl, search_id): search_id
+            for search_id in SAVED_SEARCH_IDS
+        }
+
+        for future in concurrent.futures.as_completed(futures):
+            search_id = futures[future]
 
             try:
-                db.session.execute(upsert_batch)
-                db.session.commit()
+                done = future.result()
             except Exception as e:
-                print(e)
-                db.session.rollback()
-                break
+                print(f"[{search_id}] {e}")
+                done = False
+
+            if done:
+                print(f"[{search_id}] Crawl complete")
+            else:
+                print(f"[{search_id}] Crawl stopped, rerun with HARMONIC_RESUME=1")
+
 
-        data = []
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,10 @@
 import json
 import os
-import time
 import typing
 
-import requests
-import sqlalchemy
-
 import src.utils as utils
+from src.collect.client import get_client
+from src.utils.bulk_upsert import bulk_upsert
 
 db = utils.db
 
@@ -14,36 +12,14 @@ MAX_NUM_RECORDS = 100
 
 PDL_URL = "https://api.peopledatalabs.com/v5/company/search"
 
-metadata = sqlalchemy.MetaData(bind=db.connection)
-sqlalchemy.MetaData.reflect(metadata)
-
-peopledatabase = metadata.tables["peopledatabase"]
-
 
 def get_companies_from_supabase_peopledatabase() -> typing.List[typing.Any]:
-    return list(db.session.query(peopledatabase))
-
-
-class RateLimitError(Exception):
-    pass
-
+    # Reuses the cached reflection of utils.db instead of reflecting again
+    peopledatabase = db.schema.metadata.tables["peopledatabase"]
 
-def retry_if_rate_limit_error(func: typing.Callable[[typing.Any], typing.Any]):
-    def _wrapper(*args, **kwargs):
-        for _ in range(3):
-            try:
-                return func(*args, **kwargs)
-            except RateLimitError:
-                print("Rate limit error, retrying in 60 seconds")
-                time.sleep(60)
-            except Exception as e:
-                raise e
-        raise Exception("Rate limit error, max retries reached")
-
-    return _wrapper
+    return list(db.session.query(peopledatabase))
 
 
-@retry_if_rate_limit_error
 def get_pdl_company_detail(
     cursor: typing.Optional[str] = None, companies: typing.Any = None
 ):
@@ -62,12 +38,7 @@ def get_pdl_company_detail(
         "cursor": cursor,
     }
 
-    response = requests.post(PDL_URL, headers=headers, json=params)
-
-    if response.status_code == 429:
-        raise RateLimitError(
-            f"Rate limit Error: {response.status_code} {response.text}"
-        )
+    response = get_client("peopledatalabs").post(PDL_URL, headers=headers, json=params)
 
     if response.status_code >= 400:
         print("Error:", response.status_code)
@@ -86,24 +57,7 @@ def insert_batch_supabase_headcount_sales_eng(company_details: typing.List[dict]
         print(
             f"Upserting {len(company_details)} companies headcount details (sales/eng)"
         )
-        upsert_batch = sqlalchemy.dialects.postgresql.insert(
-            db.schema.classes.pdl_headcount_sales_eng
-        ).values(company_details)
-        upsert_batch = upsert_batch.on_conflict_do_update(
-            index_elements=["id"],
-            set_={
-                key: getattr(upsert_batch.excluded, key)
-                for key in company_details[0].keys()
-            },
-        )
-
-        try:
-            db.session.execute(upsert_batch)
-            db.session.commit()
-        except Exception as e:
-            print(e)
-            db.session.rollback()
-            raise e
+        bulk_upsert("pdl_headcount_sales_eng", company_details)
 
     return company_details
 
@@ -1,23 +1,66 @@
+import concurrent.futures
+import datetime
 import os
+import threading
+import typing
 
 import github
-import pandas as pd
-import requests
 import sqlalchemy
 import tqdm
 
 import src.utils as utils
+from src.collect import github_graphql
+from src.collect.client import get_client
+from src.utils.state import StateFile
+from src.utils.write_behind import WriteBehindWriter, upsert_handler
 
 db = utils.db
 
 BASE_URL = "https://predictleads.com/api/v3"
 
-query = sqlalchemy.select(db.schema.classes.companies)
+# Number of companies enriched at the same time (1 = sequential)
+CONCURRENCY = int(os.environ.get("PREDICTLEADS_CONCURRENCY", 8))
 
-companies = pd.read_sql(query, db.connection)
-companies = companies.to_dict(orient="records")
+# Maximum number of in-flight requests against a single host
+PER_HOST_LIMIT = int(os.environ.get("PREDICTLEADS_PER_HOST_LIMIT", 4))
 
-g = github.Github(os.environ.get("GITHUB_API_KEY"))
+# Organizations or repositories buffered before they are written
+BATCH_SIZE = int(os.environ.get("PREDICTLEADS_BATCH_SIZE", 500))
+
+# Skip the companies already enriched by a previous run
+RESUME = os.environ.get("PREDICTLEADS_RESUME", "false").lower() in ("1", "true", "yes")
+
+# Fetch owners with batched GraphQL queries instead of several REST calls each
+USE_GRAPHQL = os.environ.get("GITHUB_USE_GRAPHQL", "true").lower() in (
+    "1",
+    "true",
+    "yes",
+)
+
+progress = StateFile(
+    os.environ.get("PREDICTLEADS_STATE_FILE", ".state/predictleads_progress.json")
+)
+
+# Keep-alive connections shared by every worker thread
+predictleads = get_client("predictleads", pool_size=PER_HOST_LIMIT)
+
+# PyGithub retries and honors the GitHub rate limit headers on its own
+g = github.Github(os.environ.get("GITHUB_API_KEY"), pool_size=CONCURRENCY)
+github_limit = threading.BoundedSemaphore(PER_HOST_LIMIT)
+
+
+def get_companies() -> typing.Iterator[dict]:
+    """
+    Stream the id and domain of every company from a server-side cursor
+    """
+    companies = db.schema.classes.companies
+    query = sqlalchemy.select(companies.id, companies.domain).execution_options(
+        yield_per=1_000
+    )
+
+    with sqlalchemy.orm.Session(db.connection) as session:
+        for row in session.execute(query):
+            yield {"id": row.id, "domain": row.domain}
 
 
 def get_github(domain: str):
@@ -27,140 +70,345 @@ def get_github(domain: str):
     }
 
     URL = f"{BASE_URL}/companies/{domain}/github_repositories"
-    response = requests.get(URL, headers=headers)
+    response = predictleads.get(URL, headers=headers)
+
+    # Only an unknown domain means no Github, other errors raise so the company
+    # is not recorded as done and a resumed run looks it up again
+    if response.status_code == 404:
+        return None
+
+    response.raise_for_status()
+    return response.json()
+
+
+def get_owner(owner: str, company_id: str):
+    """
+    Fetch the organization and its top 3 repositories for a Github owner
+    """
+    org = None
+
+    try:
+        org = g.get_organization(owner).raw_data
+    except:
+        pass
+
+    if org is None:
+        return None, []
+
+    organization = {
+        "name": org.get("name"),
+        "url": org.get("url"),
+        "homepage_url": org.get("blog"),
+        "followers": org.get("followers"),
+        "company_id": company_id,
+        "id": org.get("id"),
+    }
+
+    repositories = []
+
+    repo_count = 0
+    for repo in g.get_user(owner).get_repos(sort="stargazers_count", direction="desc"):
+        repo_count += 1
+
+        if repo_count > 3:
+            break
+
+        print(f"Processing {repo.full_name}")
+        license = repo.__dict__.get("_rawData", {}).get("license", {})
+
+        if license is None:
+            license = {}
+
+        readme = None
+
+        try:
+            readme = repo.get_readme().decoded_content
+            readme = readme.decode("utf-8")
+        except:
+            pass
 
-    if response.status_code >= 400:
-        print("Error:", response.status_code)
-        return
+        repository = {
+            "id": repo.id,
+            "full_name": repo.full_name,
+            "name": repo.name,
+            "url": repo.html_url,
+            "description": repo.description,
+            "readme": readme,
+            "fork": repo.fork,
+            "pushed_at": repo.pushed_at,
+            "homepage_url": repo.homepage,
+            "size": repo.size,
+            "stargazers_count": repo.stargazers_count,
+            "watchers_count": repo.watchers_count,
+            "forks_count": repo.forks_count,
+            "language": repo.language,
+            "archived": repo.archived,
+            "disabled": repo.__dict__.get("_rawData", {}).get("disabled", None),
+            "license_key": license.get("key", None),
+            "license_name": license.get("name", None),
+            "license_url": license.get("url", None),
+            "topics": repo.raw_data.get("topics", []),
+            "organization_id": org.get("id"),
+        }
 
-    data = response.json()
-    return data
+        repositories.append(repository)
 
+    return organization, repositories
 
-organizations = []
-repositories = []
 
-for company in tqdm.tqdm(companies):
+def find_owners(company: dict) -> typing.List[str]:
+    """
+    Github owners of the repositories PredictLeads found for a company
+    """
     print(f"Trying to find Github for {company.get('domain')}")
 
     company_github = get_github(company.get("domain"))
 
     if company_github is None:
         print(f"No Github found for {company.get('domain')}")
-        continue
+        return []
 
     company_github = [
         repository.get("attributes", {}).get("url").replace("https://github.com/", "")
         for repository in company_github.get("data", [])
     ]
 
-    owners = list(set([repository.split("/")[0] for repository in company_github]))
+    return list(set([repository.split("/")[0] for repository in company_github]))
 
-    for owner in owners:
-        org = None
 
-        try:
-            org = g.get_organization(owner).raw_data
-        except:
-            pass
+def enrich_company(company: dict):
+    """
+    Find the Github organizations and repositories of a company with PyGithub,
+    safe to run from several worker threads at once
+    """
+    organizations = []
+    repositories = []
 
-        if org is None:
-            continue
+    for owner in find_owners(company):
+        # PyGithub paginates lazily, so hold the slot for the whole owner
+        with github_limit:
+            organization, owner_repositories = get_owner(owner, company.get("id"))
 
-        organization = {
-            "name": org.get("name"),
-            "url": org.get("url"),
-            "homepage_url": org.get("blog"),
-            "followers": org.get("followers"),
-            "company_id": company.get("id"),
-            "id": org.get("id"),
-        }
+        if organization is None:
+            continue
 
         organizations.append(organization)
+        repositories.extend(owner_repositories)
+
+    return organizations, repositories
+
+
+def fetch_owners(owners: typing.List[str]):
+    with github_limit:
+        return github_graphql.fetch_owners(owners)
+
 
-        repo_count = 0
-        for repo in g.get_user(owner).get_repos(
-            sort="stargazers_count", direction="desc"
-        ):
-            repo_count += 1
-
-            if repo_count > 3:
-                break
+class Batch:
+    """
+    Organizations and repositories waiting to be written, deduplicated by id, with
+    the companies they complete
+    """
+
+    def __init__(self):
+        self.organizations: typing.Dict[typing.Any, dict] = {}
+        self.repositories: typing.Dict[typing.Any, dict] = {}
+        self.company_ids: typing.List[str] = []
 
-            print(f"Processing {repo.full_name}")
-            license = repo.__dict__.get("_rawData", {}).get("license", {})
-
-            if license is None:
-                license = {}
-
-            readme = None
-
-            try:
-                readme = repo.get_readme().decoded_content
-                readme = readme.decode("utf-8")
-            except:
-                pass
-
-            repository = {
-                "id": repo.id,
-                "full_name": repo.full_name,
-                "name": repo.name,
-                "url": repo.html_url,
-                "description": repo.description,
-                "readme": readme,
-                "fork": repo.fork,
-                "pushed_at": repo.pushed_at,
-                "homepage_url": repo.homepage,
-                "size": repo.size,
-                "stargazers_count": repo.stargazers_count,
-                "watchers_count": repo.watchers_count,
-                "forks_count": repo.forks_count,
-                "language": repo.language,
-                "archived": repo.archived,
-                "disabled": repo.__dict__.get("_rawData", {}).get("disabled", None),
-                "license_key": license.get("key", None),
-                "license_name": license.get("name", None),
-                "license_url": license.get("url", None),
-                "topics": repo.raw_data.get("topics", []),
-                "organization_id": org.get("id"),
-            }
-
-            repositories.append(repository)
-
-    if len(organizations) > 0:
-        upsert_orgs = sqlalchemy.dialects.postgresql.insert(
-            db.schema.classes.github_organizations
-        ).values(organizations)
-        upsert_orgs = upsert_orgs.on_conflict_do_update(
-            index_elements=["id"],
-            set_={
-                key: getattr(upsert_orgs.excluded, key)
-                for key in organizations[0].keys()
-            },
-        )
+    def add(
+        self, organizations, repositories, company_ids: typing.Iterable[str] = ()
+    ):
+        """
+        :param company_ids: Companies whose every owner is now in the batch.
+        """
+        # The same organization can be found through several companies
+        for organization in organizations:
+            self.organizations[organization["id"]] = organization
 
-        try:
-            db.session.execute(upsert_orgs)
-            db.session.commit()
-            # organizations = []
-        except Exception as e:
-            print(e)
-
-    if len(repositories) > 0:
-        upsert_repos = sqlalchemy.dialects.postgresql.insert(
-            db.schema.classes.github_repositories
-        ).values(repositories)
-        upsert_repos = upsert_repos.on_conflict_do_update(
-            index_elements=["id"],
-            set_={
-                key: getattr(upsert_repos.excluded, key)
-                for key in repositories[0].keys()
-            },
-        )
+        for repository in repositories:
+            self.repositories[repository["id"]] = repository
+
+        self.company_ids.extend(company_ids)
+
+    def full(self) -> bool:
+        return max(len(self.organizations), len(self.repositories)) >= BATCH_SIZE
+
+    def flush(self, writer: WriteBehindWriter):
+        """
+        Hand the batch to the writer, its companies are marked as done once the
+        rows are written
+        """
+        writer.put("github_organizations", self.organizations.values())
+        writer.put("github_repositories", self.repositories.values())
+
+        company_ids = self.company_ids
+
+        def done():
+            github_graphql.save_etags()
+            done_at = datetime.datetime.now(datetime.timezone.utc).isoformat()
+            progress.update({company_id: done_at for company_id in company_ids})
+
+        writer.call(done)
+
+        self.organizations = {}
+        self.repositories = {}
+        self.company_ids = []
+
+
+class OwnerQueue:
+    """
+    Owners of several companies gathered into full GraphQL queries, a company is
+    complete once all of its owners are fetched
+    """
+
+    def __init__(self):
+        # Owner to the companies it was found through, waiting for a query
+        self.owners: typing.Dict[str, typing.List[str]] = {}
+        # Owners of each company not fetched yet
+        self.remaining: typing.Dict[str, int] = {}
+        self.failed: typing.Set[str] = set()
+
+    def add(self, company_id: str, owners: typing.List[str]):
+        self.remaining[company_id] = len(owners)
+
+        for owner in owners:
+            self.owners.setdefault(owner, []).append(company_id)
+
+    def take(self) -> typing.Dict[str, typing.List[str]]:
+        owners = list(self.owners)[: github_graphql.BATCH_SIZE]
+        return {owner: self.owners.pop(owner) for owner in owners}
+
+    def fetched(self, owner_companies: typing.Dict[str, typing.List[str]], results):
+        """
+        Organizations and repositories of a finished query, with the companies
+        it completed. `results` is None when the whole query failed, and owners
+        missing from it were in a failed batch.
+        """
+        organizations = []
+        repositories = []
+        completed = []
+
+        for owner, company_ids in owner_companies.items():
+            failed = results is None or owner not in results
+            organization, owner_repositories = (results or {}).get(owner, (None, []))
+
+            for company_id in company_ids:
+                if failed:
+                    self.failed.add(company_id)
+                elif organization is not None:
+                    organizations.append({**organization, "company_id": company_id})
+                    repositories.extend(owner_repositories)
+
+                self.remaining[company_id] -= 1
+
+                if self.remaining[company_id] == 0:
+                    del self.remaining[company_id]
+
+                    # Not marked as done, a resumed run retries it
+                    if company_id in self.failed:
+                        self.failed.discard(company_id)
+                    else:
+                        completed.append(company_id)
+
+        return organizations, repositories, completed
+
+
+def main():
+    companies = (
+        company
+        for company in get_companies()
+        if not (RESUME and progress.get(company["id"]))
+    )
+
+    batch = Batch()
+    owners = OwnerQueue()
+
+    # Repositories reference their organization, so organizations are written first
+    writer = WriteBehindWriter(
+        {
+            "github_organizations": upsert_handler("github_organizations"),
+            "github_repositories": upsert_handler("github_repositories"),
+        }
+    )
+
+    # Workers only talk to the network, every database write happens on the
+    # writer thread. At most 2 companies per worker are in flight, so memory
+    # stays bounded. With GraphQL the workers first find the owners of each
+    # company, then owners of several companies are fetched in one query.
+    with writer, concurrent.futures.ThreadPoolExecutor(
+        max_workers=CONCURRENCY
+    ) as executor:
+        pending = {}
+        looking_up = 0
+        exhausted = False
+        progress_bar = tqdm.tqdm()
+
+        while True:
+            # The last partial query waits until every owner is known
+            while len(owners.owners) >= github_graphql.BATCH_SIZE or (
+                owners.owners and exhausted and not looking_up
+            ):
+                owner_companies = owners.take()
+                future = executor.submit(fetch_owners, list(owner_companies))
+                pending[future] = ("owners", owner_companies)
+
+            while not exhausted and len(pending) < 2 * CONCURRENCY:
+                company = next(companies, None)
+
+                if company is None:
+                    exhausted = True
+                    break
+
+                task = find_owners if USE_GRAPHQL else enrich_company
+                pending[executor.submit(task, company)] = ("company", company)
+                looking_up += 1
+
+            if not pending:
+                break
 
-        try:
-            db.session.execute(upsert_repos)
-            db.session.commit()
-            # repositories = []
-        except Exception as e:
-            print(e)
+            done, _ = concurrent.futures.wait(
+                pending, return_when=concurrent.futures.FIRST_COMPLETED
+            )
+
+            for future in done:
+                kind, item = pending.pop(future)
+
+                if kind == "owners":
+                    try:
+                        results = future.result()
+                    except Exception as e:
+                        print(f"Error fetching owners {list(item)}: {e}")
+                        results = None
+
+                    organizations, repositories, completed = owners.fetched(
+                        item, results
+                    )
+                    batch.add(organizations, repositories, completed)
+                    progress_bar.update(len(completed))
+
+                else:
+                    looking_up -= 1
+
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        print(f"Error for {item.get('domain')}: {e}")
+                        continue
+
+                    if not USE_GRAPHQL:
+                        batch.add(*result, [item["id"]])
+                        progress_bar.update()
+                    elif result:
+                        owners.add(item["id"], result)
+                    else:
+                        batch.add([], [], [item["id"]])
+                        progress_bar.update()
+
+                if batch.full():
+                    batch.flush(writer)
+
+        progress_bar.close()
+        batch.flush(writer)
+
+
+if __name__ == "__main__":
+    main()
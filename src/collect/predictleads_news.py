@@ -1,41 +1,89 @@
+import datetime
 import os
-from typing import Any, Dict
+from typing import Any, Dict, List, Optional
 
-import pandas as pd
-import requests
 import sqlalchemy
-from sqlalchemy.dialects import postgresql
 
 import src.utils as utils
+from src.collect.client import get_client
+from src.utils.topics import EXCLUDED_TOPIC_IDS
+from src.utils.write_behind import WriteBehindWriter, upsert_handler
 
 db = utils.db
 
 BASE_URL = "https://predictleads.com/api/v3"
 
-# Get companies
-query = sqlalchemy.select(db.schema.classes.companies).where(
-    db.schema.classes.companies.topic_id != 14
+# Only request the events found since the latest stored event of each company,
+# and insert new events without rewriting the stored ones
+INCREMENTAL = os.environ.get("PREDICTLEADS_NEWS_INCREMENTAL", "true").lower() in (
+    "1",
+    "true",
+    "yes",
 )
 
-companies = pd.read_sql(query, db.connection)
-companies = companies.to_dict(orient="records")
+
+def get_companies() -> List[dict]:
+    companies = db.schema.classes.companies
+    query = sqlalchemy.select(companies.id, companies.domain).where(
+        companies.topic_id.not_in(EXCLUDED_TOPIC_IDS)
+    )
+
+    with db.connection.connect() as connection:
+        return [
+            {"id": row.id, "domain": row.domain}
+            for row in connection.execute(query)
+        ]
+
+
+def get_watermarks() -> Dict[str, datetime.date]:
+    """
+    Day (UTC, like the API) of the latest stored event of every company, in one
+    query
+    """
+    query = sqlalchemy.text(
+        """
+        SELECT company_id, max(found_at) AS latest
+        FROM predict_leads_news
+        GROUP BY company_id
+        """
+    )
+
+    with db.connection.connect() as connection:
+        return {
+            row.company_id: row.latest.astimezone(datetime.timezone.utc).date()
+            for row in connection.execute(query)
+            if row.latest is not None
+        }
+
+
+def create_watermark_index():
+    """
+    Index the latest event of each company, so the watermark query does not
+    scan the whole table
+    """
+    with db.connection.begin() as connection:
+        connection.execute(
+            sqlalchemy.text(
+                "CREATE INDEX IF NOT EXISTS predict_leads_news_company_found_at "
+                "ON predict_leads_news (company_id, found_at)"
+            )
+        )
 
 
-def get_news(domain: str):
+def get_news(domain: str, found_at_from: Optional[datetime.date] = None):
     headers = {
         "X-Api-Key": os.environ.get("PREDICTLEADS_API_KEY"),
         "X-Api-Token": os.environ.get("PREDICTLEADS_API_TOKEN"),
     }
 
-    URL = f"{BASE_URL}/companies/{domain}/news_events"
-    response = requests.get(URL, headers=headers)
-
-    if response.status_code >= 400:
-        print("Error:", response.status_code)
-        return
+    # The day of the watermark is requested again, its events already stored
+    # are skipped by the insert
+    params = {}
+    if found_at_from:
+        params["found_at_from"] = found_at_from.isoformat()
 
-    data = response.json()
-    return data
+    URL = f"{BASE_URL}/companies/{domain}/news_events"
+    return get_client("predictleads").get_json(URL, headers=headers, params=params)
 
 
 def transform_raw_data(company_id: str, raw_data: Dict[str, Any]) -> list:
@@ -108,59 +156,42 @@ def transform_raw_data(company_id: str, raw_data: Dict[str, Any]) -> list:
     return events
 
 
-all_events = []
-seen_ids = set()
-
-for company in companies:
-    print(f"Getting news for {company.get('domain')}")
-    company_news = get_news(company.get("domain"))
-    events = transform_raw_data(company.get("id"), company_news)
-    # Deduplicate events based on id
-    events = {event["id"]: event for event in events}.values()
+def main():
+    if INCREMENTAL:
+        create_watermark_index()
 
-    for event in events:
-        if event["id"] not in seen_ids:
-            all_events.append(event)
-            seen_ids.add(event["id"])
+    watermarks = get_watermarks() if INCREMENTAL else {}
 
-    # Batch upsert when we have enough events
-    if len(all_events) >= 100:
-        upsert_events = postgresql.insert(db.schema.classes.predict_leads_news).values(
-            all_events
-        )
-        upsert_events = upsert_events.on_conflict_do_update(
-            index_elements=["id"],
-            set_={
-                key: getattr(upsert_events.excluded, key)
-                for key in all_events[0].keys()
-            },
-        )
-
-        try:
-            db.session.execute(upsert_events)
-            db.session.commit()
-            all_events = []  # Clear the batch
-            print("Successfully upserted batch of events")
-        except Exception as e:
-            print(f"Error upserting batch: {e}")
-            db.session.rollback()
-
-# Upsert any remaining events
-if all_events:
-    upsert_events = postgresql.insert(db.schema.classes.predict_leads_news).values(
-        all_events
-    )
-    upsert_events = upsert_events.on_conflict_do_update(
-        index_elements=["id"],
-        set_={
-            key: getattr(upsert_events.excluded, key) for key in all_events[0].keys()
-        },
+    # Existing events are left untouched in incremental runs (DO NOTHING), a full
+    # run refreshes them
+    handler = upsert_handler(
+        "predict_leads_news", update_columns=[] if INCREMENTAL else None
     )
 
-    try:
-        db.session.execute(upsert_events)
-        db.session.commit()
-        print("Successfully upserted final batch of events")
-    except Exception as e:
-        print(f"Error upserting final batch: {e}")
-        db.session.rollback()
+    # Events are written in batches by a background thread while the next
+    # companies are requested, only one batch is held in memory. Duplicated
+    # events of a batch are merged by the upsert.
+    with WriteBehindWriter({"predict_leads_news": handler}) as writer:
+        for company in get_companies():
+            watermark = watermarks.get(company.get("id"))
+
+            print(
+                f"Getting news for {company.get('domain')}"
+                + (f" since {watermark}" if watermark else "")
+            )
+            company_news = get_news(company.get("domain"), watermark)
+            events = transform_raw_data(company.get("id"), company_news)
+
+            # Older events are already stored, in case the filter was not applied
+            if watermark:
+                events = [
+                    event
+                    for event in events
+                    if str(event["found_at"] or "")[:10] >= watermark.isoformat()
+                ]
+
+            writer.put("predict_leads_news", events)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,83 +1,152 @@
+import datetime
 import os
-import sys
+import typing
 
-import github
-import pandas as pd
-import requests
 import sqlalchemy
 import tqdm
 
 import src.utils as utils
+from src.collect.client import get_client
+from src.utils.bulk_copy import copy_upsert_harmonic_data
+from src.utils.topics import EXCLUDED_TOPIC_IDS
+from src.utils.write_behind import WriteBehindWriter
 
 db = utils.db
 
-BASE_URL = "https://predictleads.com/api/v3"
+# Only request the months after the latest stored visit of each company
+INCREMENTAL = os.environ.get("SIMILARWEB_INCREMENTAL", "true").lower() in (
+    "1",
+    "true",
+    "yes",
+)
 
-query = sqlalchemy.select(db.schema.classes.companies)
+# First month fetched for companies without any visits yet
+START_DATE = os.environ.get("SIMILARWEB_START_DATE", "2022-12")
 
-companies = pd.read_sql(query, db.connection)
-companies = companies[companies["topic_id"] != 14]
-companies = companies.to_dict(orient="records")
+# Last month fetched, defaults to the last complete month
+END_DATE = os.environ.get("SIMILARWEB_END_DATE")
 
 
-def get_similarweb(domain: str):
-    headers = {
-        "X-Api-Key": os.environ.get("PREDICTLEADS_API_KEY"),
+def add_months(month: datetime.date, months: int) -> datetime.date:
+    index = month.year * 12 + month.month - 1 + months
+    return datetime.date(index // 12, index % 12 + 1, 1)
+
+
+def parse_month(value: str) -> datetime.date:
+    return datetime.datetime.strptime(value, "%Y-%m").date()
+
+
+def last_complete_month() -> datetime.date:
+    return add_months(datetime.date.today().replace(day=1), -1)
+
+
+def get_companies() -> typing.List[dict]:
+    companies = db.schema.classes.companies
+    query = sqlalchemy.select(companies.id, companies.domain).where(
+        sqlalchemy.or_(
+            companies.topic_id.is_(None),
+            companies.topic_id.not_in(EXCLUDED_TOPIC_IDS),
+        )
+    )
+
+    with db.connection.connect() as connection:
+        return [
+            {"id": row.id, "domain": row.domain}
+            for row in connection.execute(query)
+        ]
+
+
+def get_latest_months() -> typing.Dict[str, datetime.date]:
+    """
+    Month of the latest stored Similarweb visits of every company, in one query
+    """
+    query = sqlalchemy.text(
+        """
+        SELECT company_id, max(date) AS latest
+        FROM harmonic_data
+        WHERE source = 'similarweb' AND type = 'similarweb_visits'
+        GROUP BY company_id
+        """
+    )
+
+    with db.connection.connect() as connection:
+        # Dates are stored as the first day of the month, possibly as timestamps
+        return {
+            row.company_id: parse_month(str(row.latest)[:7])
+            for row in connection.execute(query)
+        }
+
+
+def get_similarweb(
+    domain: str, start_date: str = START_DATE, end_date: typing.Optional[str] = None
+):
+    URL = f"https://api.similarweb.com/v1/website/{domain}/total-traffic-and-engagement/visits"
+
+    params = {
+        "api_key": os.environ.get("SIMILAR_API_KEY"),
+        "start_date": start_date,
+        "end_date": end_date or last_complete_month().strftime("%Y-%m"),
+        "country": "world",
+        "granularity": "monthly",
+        "main_domain_only": "false",
+        "format": "json",
     }
 
-    URL = f'https://api.similarweb.com/v1/website/{domain}/total-traffic-and-engagement/visits?api_key=5145365ab2a741a794892d13ec3ce7ea&start_date=2022-12&end_date=2024-12&country=world&granularity=monthly&main_domain_only=false&format=json'
-    response = requests.get(URL, headers=headers)
+    return get_client("similarweb").get_json(URL, params=params)
 
-    if response.status_code >= 400:
-        print("Error:", response.status_code)
-        print(response.text)
-        return response.json()
 
-    data = response.json()
-    return data
+def main():
+    companies = get_companies()
 
+    start = parse_month(START_DATE)
+    end = parse_month(END_DATE) if END_DATE else last_complete_month()
 
-organizations = []
-repositories = []
+    latest_months = get_latest_months() if INCREMENTAL else {}
 
-for company in tqdm.tqdm(companies):
-    data = get_similarweb(company.get("domain"))
+    skipped = 0
 
-    print(f'Getting data for domain: {company.get("domain")}')
-    
-    if data.get('meta', {}).get('error_code', None):
-        print(f"Error for {company.get('domain')}")
-        continue
-    
-    rows = []
+    # Visits are buffered across companies and bulk loaded with COPY by a
+    # background thread, while the next domains are being requested
+    writer = WriteBehindWriter({"harmonic_data": copy_upsert_harmonic_data})
 
-    for row in data.get('visits', []):
-        item = {
-            'company_id': company.get('id'),
-            'source': 'similarweb',
-            'type': 'similarweb_visits',
-            'date': row.get('date'),
-            'value': row.get('visits'),
-        }
+    with writer:
+        for company in tqdm.tqdm(companies):
+            latest = latest_months.get(company.get("id"))
+            company_start = max(start, add_months(latest, 1)) if latest else start
+
+            # Already has every month up to the end date
+            if company_start > end:
+                skipped += 1
+                continue
+
+            print(
+                f'Getting data for domain: {company.get("domain")} '
+                f"({company_start:%Y-%m} to {end:%Y-%m})"
+            )
+            data = get_similarweb(
+                company.get("domain"), f"{company_start:%Y-%m}", f"{end:%Y-%m}"
+            )
+
+            if data is None or data.get("meta", {}).get("error_code", None):
+                print(f"Error for {company.get('domain')}")
+                continue
+
+            writer.put(
+                "harmonic_data",
+                (
+                    {
+                        "company_id": company.get("id"),
+                        "source": "similarweb",
+                        "type": "similarweb_visits",
+                        "date": row.get("date"),
+                        "value": row.get("visits"),
+                    }
+                    for row in data.get("visits", [])
+                ),
+            )
+
+    print(f"Skipped {skipped} companies already up to date")
 
-        rows.append(item)
-
-   
-    if len(rows) > 0:
-        upsert_orgs = sqlalchemy.dialects.postgresql.insert(
-            db.schema.classes.harmonic_data
-        ).values(rows)
-        upsert_orgs = upsert_orgs.on_conflict_do_update(
-            index_elements=["source", "type", "company_id", "date"],
-            set_={
-                key: getattr(upsert_orgs.excluded, key)
-                for key in rows[0].keys()
-            },
-        )
 
-        try:
-            db.session.execute(upsert_orgs)
-            db.session.commit()
-            rows = []
-        except Exception as e:
-            print(e)
+if __name__ == "__main__":
+    main()
@@ -1,48 +1,175 @@
+import os
+import typing
+
+import numpy as np
+import sqlalchemy
 from sqlalchemy import select
 
-# Import the database session and schema from db.py
-from utils.db import schema, session
+import src.utils as utils
 
 from .utils.bertopic_classifier import BERTopicClassifier
 from .utils.embedder import EmbeddingPipeline
+from .utils.similarity_index import SimilarityIndex
 from .utils.topic_descriptor import TopicDescriptor
+from .utils.topic_writer import write_topics
+from .utils.vector_store import VectorStore
+
+db = utils.db
+
+# Companies read from the database and embedded at once
+BATCH_SIZE = int(os.getenv("CLASSIFIER_BATCH_SIZE", 5_000))
+
+
+def stream_companies(
+    batch_size: int = BATCH_SIZE,
+) -> typing.Iterator[typing.List[dict]]:
+    """
+    Yield batches of {"id", "description"} dicts, streamed from a server-side
+    cursor so only one batch of rows is held in memory at a time
+    """
+    companies_table = db.schema.classes.companies
+
+    # Only the columns the pipeline needs, not the tags and other long fields
+    stmt = select(companies_table.id, companies_table.description).execution_options(
+        yield_per=batch_size
+    )
+
+    with sqlalchemy.orm.Session(db.connection) as session:
+        for rows in session.execute(stmt).partitions():
+            yield [{"id": row.id, "description": row.description} for row in rows]
+
+
+def count_companies() -> int:
+    companies_table = db.schema.classes.companies
+
+    with db.connection.connect() as connection:
+        return connection.execute(
+            select(sqlalchemy.func.count()).select_from(companies_table)
+        ).scalar()
 
 
 def classify_companies():
     """
     Classify the companies into topics using BERTopic
     """
+    embedding_pipeline = EmbeddingPipeline()
+    vector_store = None
+    index = None
 
-    # If no companies are provided, fetch them from the database
-    companies_table = (
-        schema.classes.companies
-    )  # Adjust the table name as per your schema
-    stmt = select(companies_table)
-    result = session.execute(stmt).fetchall()
-    companies_list_of_dicts = [dict(row) for row in result]
-    if not companies_list_of_dicts:
-        print("No companies found in the database.")
-        return None
+    # BERTopic fits on every embedding at once, they are copied batch by batch
+    # into one preallocated matrix so no per-batch matrix stays alive
+    embeddings = None
+    company_ids = []
+    descriptions = []
 
-    embedding_pipeline = EmbeddingPipeline()
+    for companies_list_of_dicts in stream_companies():
+        batch = embedding_pipeline.get_embeddings_from_objects(companies_list_of_dicts)
 
-    companies_with_embeddings = embedding_pipeline.get_embeddings_from_objects(
-        companies_list_of_dicts
-    )
+        if not batch:
+            continue
+
+        embedded_companies = [
+            company
+            for company in batch
+            if company.get("description_embeddings") is not None
+        ]
+        batch_ids = [company["id"] for company in embedded_companies]
+        batch_embeddings = np.stack(
+            [company["description_embeddings"] for company in embedded_companies]
+        )
+
+        # Embedded by the API in this run, new or changed descriptions
+        computed = np.array(
+            [company["embedding_computed"] for company in embedded_companies]
+        )
+
+        # Persist the embeddings so similarity queries can run inside Postgres.
+        # Cached embeddings are only written when the table is missing them.
+        if vector_store is None:
+            vector_store = VectorStore(dimensions=batch_embeddings.shape[1])
+        stored = vector_store.stored_ids(batch_ids)
+        unsaved = computed | np.array(
+            [company_id not in stored for company_id in batch_ids]
+        )
+        if unsaved.any():
+            vector_store.write(
+                [company_id for company_id, ok in zip(batch_ids, unsaved) if ok],
+                batch_embeddings[unsaved],
+                embedding_pipeline.model_name,
+            )
+
+        # Keep the "similar companies" index in sync with the new embeddings.
+        # Re-inserting a known company is a full node update in HNSW, so only
+        # new companies and changed embeddings are added.
+        if os.getenv("SIMILARITY_INDEX"):
+            if index is None:
+                index = SimilarityIndex.load_or_create(batch_embeddings.shape[1])
+            unindexed = computed | np.array(
+                [company_id not in index.positions for company_id in batch_ids]
+            )
+            if unindexed.any():
+                index.add(
+                    [company_id for company_id, ok in zip(batch_ids, unindexed) if ok],
+                    batch_embeddings[unindexed],
+                )
+
+        start = len(company_ids)
+        end = start + len(batch_ids)
+
+        if embeddings is None:
+            embeddings = np.empty(
+                (max(count_companies(), end), batch_embeddings.shape[1]),
+                dtype=batch_embeddings.dtype,
+            )
+        elif end > len(embeddings):
+            # Companies were added since they were counted
+            missing = np.empty(
+                (end - len(embeddings), embeddings.shape[1]), dtype=embeddings.dtype
+            )
+            embeddings = np.concatenate([embeddings, missing])
+
+        embeddings[start:end] = batch_embeddings
+        company_ids.extend(batch_ids)
+        descriptions.extend(company["description"] for company in embedded_companies)
+        print(f"Embedded {len(company_ids)} companies")
 
-    if not companies_with_embeddings:
+    if not company_ids:
         print("No embeddings found, embed the descriptions first")
         return None
 
+    embeddings = embeddings[: len(company_ids)]
+
+    # Rows are views on the single matrix
+    companies_with_embeddings = [
+        {"id": company_id, "description": description, "description_embeddings": row}
+        for company_id, description, row in zip(company_ids, descriptions, embeddings)
+    ]
+
+    if index is not None:
+        index.save()
+
+        if os.getenv("SIMILARITY_KNN_TABLE"):
+            index.write_knn_table(k=int(os.getenv("SIMILARITY_KNN_K", 10)))
+
     bertopic_classifier = BERTopicClassifier()
+
     companies_with_topics = bertopic_classifier.classify_bertopic(
         companies_with_embeddings
     )
 
+    topic_ids = write_topics(
+        companies_with_embeddings,
+        bertopic_classifier.topic_names,
+        refitted=bertopic_classifier.refitted,
+        topic_ids=bertopic_classifier.topic_ids,
+    )
+    bertopic_classifier.save_topic_ids(topic_ids)
+
     topic_descriptor = TopicDescriptor()
     topic_descriptor.get_topic_descriptions_and_upsert_in_db()
 
     return companies_with_topics
 
 
-classify_companies()
+if __name__ == "__main__":
+    classify_companies()
@@ -0,0 +1,74 @@
+import os
+import typing
+
+import numpy as np
+import sqlalchemy
+
+import src.utils as utils
+
+from .utils.bertopic_classifier import BERTopicClassifier
+from .utils.embedder import EmbeddingPipeline, preprocess_texts
+
+db = utils.db
+
+# Companies compared, drawn at random
+SAMPLE_SIZE = int(os.getenv("EMBEDDING_COMPARE_SAMPLE_SIZE", 20_000))
+
+
+def sample_descriptions(sample_size: int = SAMPLE_SIZE) -> typing.List[str]:
+    """
+    Random sample of the company descriptions, drawn in SQL so only the sample
+    leaves the database
+    """
+    with db.connection.connect() as connection:
+        return list(
+            connection.execute(
+                sqlalchemy.text(
+                    "SELECT description FROM companies "
+                    "WHERE description IS NOT NULL "
+                    "ORDER BY random() LIMIT :sample_size"
+                ),
+                {"sample_size": sample_size},
+            ).scalars()
+        )
+
+
+def main():
+    """
+    Report what the EMBEDDING_DIMENSIONS and EMBEDDING_DTYPE embeddings cost
+    against the full-dimension float32 baseline, on a sample of the companies
+    """
+    reduced_pipeline = EmbeddingPipeline()
+
+    if not reduced_pipeline.dimensions and reduced_pipeline.dtype == np.float32:
+        print("EMBEDDING_DIMENSIONS and EMBEDDING_DTYPE are unset, nothing to compare")
+        return None
+
+    descriptions, token_counts = preprocess_texts(
+        sample_descriptions(), reduced_pipeline.model_name
+    )
+
+    if not descriptions:
+        print("No descriptions found")
+        return None
+
+    # The reduced embeddings usually come from the cache of the classifier runs
+    reduced_embeddings, reduced_mask = reduced_pipeline.embed_texts(
+        descriptions, token_counts
+    )
+    full_embeddings, full_mask = EmbeddingPipeline(
+        dimensions=None, dtype="float32"
+    ).embed_texts(descriptions, token_counts)
+
+    mask = reduced_mask & full_mask
+    print(f"Comparing the embeddings of {mask.sum()} companies")
+
+    return BERTopicClassifier().compare_with_baseline(
+        [description for description, ok in zip(descriptions, mask) if ok],
+        full_embeddings[mask],
+        reduced_embeddings[mask],
+    )
+
+
+if __name__ == "__main__":
+    main()
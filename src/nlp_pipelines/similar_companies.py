@@ -0,0 +1,45 @@
+import os
+import sys
+
+from .utils.similarity_index import SimilarityIndex
+from .utils.vector_store import VectorStore
+
+
+def build_index() -> SimilarityIndex:
+    """
+    Build the similarity index from the embeddings stored in Postgres
+    """
+    ids, embeddings = VectorStore().read()
+
+    index = SimilarityIndex.load_or_create(embeddings.shape[1])
+    index.add(ids, embeddings)
+    index.save()
+
+    if os.getenv("SIMILARITY_KNN_TABLE"):
+        index.write_knn_table(k=int(os.getenv("SIMILARITY_KNN_K", 10)))
+
+    return index
+
+
+def main():
+    """
+    python -m src.nlp_pipelines.similar_companies [company id or free text]
+    """
+    if len(sys.argv) < 2:
+        build_index()
+        return
+
+    index = SimilarityIndex.load()
+    query = " ".join(sys.argv[1:])
+
+    if query in index.positions:
+        results = index.similar(query)
+    else:
+        results = index.search(query)
+
+    for company_id, score in results:
+        print(f"{score:.3f}  {company_id}")
+
+
+if __name__ == "__main__":
+    main()
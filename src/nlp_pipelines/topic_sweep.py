@@ -0,0 +1,67 @@
+import os
+
+import sqlalchemy
+
+import src.utils as utils
+
+from .utils.topic_sweep import sweep
+from .utils.vector_store import VectorStore
+
+db = utils.db
+
+
+def parse_list(name: str, default: str) -> list:
+    values = []
+
+    for value in os.getenv(name, default).split(","):
+        value = value.strip().lower()
+
+        if value in ("none", ""):
+            values.append(None)
+        elif value == "auto":
+            values.append("auto")
+        else:
+            values.append(int(value))
+
+    return values
+
+
+def main():
+    """
+    Score BERTopic configurations on the stored embeddings, without touching the
+    topics in the database
+    """
+    ids, embeddings = VectorStore().read()
+
+    if not ids:
+        print("No embeddings found, run the classifier pipeline first")
+        return None
+
+    with db.connection.connect() as connection:
+        rows = connection.execute(
+            sqlalchemy.text(
+                "SELECT id, description FROM companies WHERE id = ANY(:ids)"
+            ),
+            {"ids": ids},
+        )
+        descriptions = {row.id: row.description or "" for row in rows}
+
+    results = sweep(
+        [descriptions.get(company_id, "") for company_id in ids],
+        embeddings,
+        min_topic_sizes=parse_list("TOPIC_SWEEP_MIN_TOPIC_SIZES", "5,10,20,40"),
+        min_samples=parse_list("TOPIC_SWEEP_MIN_SAMPLES", "none"),
+        nr_topics=parse_list("TOPIC_SWEEP_NR_TOPICS", "auto,none"),
+        n_components=parse_list("TOPIC_SWEEP_N_COMPONENTS", "5"),
+        workers=int(os.getenv("TOPIC_SWEEP_WORKERS", 0)) or None,
+    )
+
+    print("Best configurations:")
+    for result in results[:5]:
+        print(result)
+
+    return results
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,21 @@
+import hashlib
+import json
+import os
 import re
+import time
+import typing
 
 import numpy as np
 from bertopic import BERTopic
+from sklearn.metrics import adjusted_rand_score, normalized_mutual_info_score
+
+from .reducer import CachedReducer
+
+
+MODEL_DIR = os.getenv("BERTOPIC_MODEL_DIR", ".cache/bertopic_model")
+
+# Reuse the saved model for new or changed companies instead of refitting
+INCREMENTAL = os.getenv("BERTOPIC_INCREMENTAL", "false").lower() in ("1", "true", "yes")
 
 
 class BERTopicClassifier:
@@ -9,34 +23,76 @@ class BERTopicClassifier:
     Class to classify the companies into topics using BERTopic
     """
 
-    def __init__(self):
-        pass
+    def __init__(
+        self,
+        model_dir: typing.Optional[str] = MODEL_DIR,
+        incremental: bool = INCREMENTAL,
+        max_new_ratio: float = 0.2,
+        max_similarity_drift: float = 0.05,
+        min_topic_size: int = 10,
+        nr_topics: typing.Union[int, str, None] = "auto",
+        reducer: typing.Optional[CachedReducer] = None,
+    ):
+        """
+        :param model_dir: Where the fitted model is saved, None disables persistence.
+        :param incremental: Only assign topics to new or changed companies with the
+            saved model, instead of refitting on the whole company base.
+        :param max_new_ratio: Refit when new or changed companies exceed this share
+            of the companies the saved model was fitted on.
+        :param max_similarity_drift: Refit when the mean similarity of the new
+            companies to their topic drops this much below the fit baseline.
+        """
+        self.model_dir = model_dir
+        self.incremental = incremental
+        self.max_new_ratio = max_new_ratio
+        self.max_similarity_drift = max_similarity_drift
+        self.min_topic_size = min_topic_size
+        self.nr_topics = nr_topics
+        self.reducer = reducer or CachedReducer()
+
+        # Set by classify_bertopic, for the write-back
+        self.topic_names: typing.Dict[int, str] = {}
+        self.refitted = False
+
+        # BERTopic id to topics.id of the saved model, see save_topic_ids
+        self.topic_ids: typing.Dict[int, int] = {}
 
     def classify_bertopic(self, companies_list_of_dicts: list):
         """
         Classify the companies into topics using BERTopic
         """
 
-        cleaned_descriptions = [
-            company["description"] for company in companies_list_of_dicts
-        ]
-
-        all_embeddings = [
-            company.get("description_embeddings")
+        # Companies whose description could not be embedded are left out
+        companies_list_of_dicts = [
+            company
             for company in companies_list_of_dicts
             if company.get("description_embeddings") is not None
         ]
-        if not all_embeddings:
+        if not companies_list_of_dicts:
             print("No embeddings found, embed the descriptions first")
             return None
 
-        all_embeddings_array = np.array(all_embeddings)
+        if self.incremental:
+            cleaned_topic_names = self._classify_incremental(companies_list_of_dicts)
+
+            if cleaned_topic_names is not None:
+                return cleaned_topic_names
 
-        topic_model = BERTopic(
-            min_topic_size=10,
-            calculate_probabilities=True,
-            verbose=True,
-            nr_topics="auto",
+        return self._classify_full(companies_list_of_dicts)
+
+    def _classify_full(self, companies_list_of_dicts: list):
+        cleaned_descriptions = [
+            company["description"] for company in companies_list_of_dicts
+        ]
+
+        all_embeddings_array = stack_embeddings(
+            [company["description_embeddings"] for company in companies_list_of_dicts]
+        )
+
+        topic_model = build_topic_model(
+            min_topic_size=self.min_topic_size,
+            nr_topics=self.nr_topics,
+            umap_model=self.reducer,
         )
         topics, probs = topic_model.fit_transform(
             cleaned_descriptions,
@@ -46,19 +102,326 @@ class BERTopicClassifier:
         topic_info = topic_model.get_topic_info()
         print(topic_info)
 
-        topic_names = topic_model.get_topic_info()["Name"]
-        cleaned_topic_names = [
-            clean_topic_name(clean_topic_name(name)) for name in topic_names
+        cleaned_topic_names = get_cleaned_topic_names(topic_model)
+        self.topic_names = cleaned_topic_names
+        self.refitted = True
+        self.topic_ids = {}
+
+        # Outliers (-1) have no probability column
+        probabilities = [
+            float(probs[i][topic_id]) if topic_id >= 0 else 0.0
+            for i, topic_id in enumerate(topics)
+        ]
+        assign_topics(
+            companies_list_of_dicts, topics, probabilities, cleaned_topic_names
+        )
+
+        if self.model_dir:
+            self._save(topic_model, companies_list_of_dicts, all_embeddings_array)
+
+        return list(cleaned_topic_names.values())
+
+    def _classify_incremental(self, companies_list_of_dicts: list):
+        """
+        Assign topics to new or changed companies only, returns None when a full
+        refit is needed
+        """
+        manifest_path = os.path.join(self.model_dir or "", "manifest.json")
+
+        if not self.model_dir or not os.path.exists(manifest_path):
+            print("No saved topic model, fitting from scratch")
+            return None
+
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+
+        # The topics of the saved model were never written to the database
+        if not manifest.get("topic_ids"):
+            print("Saved topic model has no database topics, fitting from scratch")
+            return None
+
+        companies = manifest["companies"]
+        changed = [
+            company
+            for company in companies_list_of_dicts
+            if companies.get(str(company["id"])) != description_hash(company)
         ]
 
-        for i, company in enumerate(companies_list_of_dicts):
-            topic_id = topics[i]
-            company["derived_topic"] = cleaned_topic_names[topic_id]
-            company["derived_topic_probability"] = float(
-                probs[i][topic_id]
-            )  # Ensure it's a float
+        topic_model = BERTopic.load(self.model_dir)
+        cleaned_topic_names = get_cleaned_topic_names(topic_model)
+        self.topic_names = cleaned_topic_names
+        self.refitted = False
+        self.topic_ids = {
+            int(topic_id): database_id
+            for topic_id, database_id in manifest["topic_ids"].items()
+        }
+
+        if not changed:
+            print("No new or changed companies, topics are up to date")
+            return list(cleaned_topic_names.values())
+
+        if len(changed) > self.max_new_ratio * len(companies):
+            print(
+                f"{len(changed)} new or changed companies out of {len(companies)}, "
+                "refitting the topic model"
+            )
+            return None
+
+        start = time.time()
+        embeddings = stack_embeddings(
+            [company["description_embeddings"] for company in changed]
+        )
+        topics, similarities = nearest_topics(topic_model, embeddings)
+
+        similarity = float(np.mean(similarities))
+        if similarity < manifest["similarity"] - self.max_similarity_drift:
+            print(
+                f"Topic similarity drifted from {manifest['similarity']:.3f} to "
+                f"{similarity:.3f}, refitting the topic model"
+            )
+            return None
+
+        # Cosine similarities are not on the scale of the HDBSCAN probabilities
+        # of the fitted companies, the probability is left unknown (NULL)
+        assign_topics(changed, topics, [None] * len(changed), cleaned_topic_names)
+
+        for company in changed:
+            companies[str(company["id"])] = description_hash(company)
+
+        self._write_manifest(companies, manifest["similarity"], self.topic_ids)
+
+        print(
+            f"Assigned topics to {len(changed)} new or changed companies "
+            f"in {time.time() - start:.2f}s"
+        )
+        return list(cleaned_topic_names.values())
+
+    def _save(self, topic_model: BERTopic, companies_list_of_dicts, embeddings):
+        topic_model.save(
+            self.model_dir,
+            serialization="safetensors",
+            save_ctfidf=True,
+            save_embedding_model=False,
+        )
+
+        _, similarities = nearest_topics(topic_model, embeddings)
+        self._write_manifest(
+            {
+                str(company["id"]): description_hash(company)
+                for company in companies_list_of_dicts
+            },
+            float(np.mean(similarities)),
+        )
+        print(f"Saved the topic model to {self.model_dir}")
+
+    def _write_manifest(
+        self,
+        companies: typing.Dict[str, str],
+        similarity: float,
+        topic_ids: typing.Optional[typing.Dict[int, int]] = None,
+    ):
+        with open(os.path.join(self.model_dir, "manifest.json"), "w") as f:
+            json.dump(
+                {
+                    "companies": companies,
+                    "similarity": similarity,
+                    "topic_ids": {
+                        str(topic_id): database_id
+                        for topic_id, database_id in (topic_ids or {}).items()
+                    },
+                },
+                f,
+            )
+
+    def save_topic_ids(self, topic_ids: typing.Dict[int, int]):
+        """
+        Record the database ids the topics were written under, incremental runs
+        reuse them
+        """
+        self.topic_ids = topic_ids
+
+        manifest_path = os.path.join(self.model_dir or "", "manifest.json")
+        if not self.model_dir or not os.path.exists(manifest_path):
+            return
+
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+
+        self._write_manifest(manifest["companies"], manifest["similarity"], topic_ids)
+
+    def compare_with_baseline(
+        self,
+        descriptions: typing.List[str],
+        full_embeddings: np.ndarray,
+        reduced_embeddings: np.ndarray,
+        k: int = 10,
+        sample_size: int = 2_000,
+    ) -> dict:
+        """
+        Report how much clustering quality is lost with reduced-dimension or float16
+        embeddings, compared to the full-dimension baseline
+        """
+        report = {
+            "full_dimensions": full_embeddings.shape[1],
+            "reduced_dimensions": reduced_embeddings.shape[1],
+            "full_megabytes": full_embeddings.nbytes / 1e6,
+            "reduced_megabytes": reduced_embeddings.nbytes / 1e6,
+            "neighbour_overlap": neighbour_overlap(
+                full_embeddings, reduced_embeddings, k, sample_size
+            ),
+        }
+
+        assignments = {}
+        for name, embeddings in (
+            ("full", full_embeddings),
+            ("reduced", reduced_embeddings),
+        ):
+            start = time.time()
+            topics, _ = build_topic_model(
+                calculate_probabilities=False, umap_model=CachedReducer()
+            ).fit_transform(descriptions, stack_embeddings(embeddings))
+            report[f"{name}_seconds"] = time.time() - start
+            report[f"{name}_topics"] = len(set(topics) - {-1})
+            report[f"{name}_outlier_ratio"] = float(np.mean(np.asarray(topics) == -1))
+            assignments[name] = topics
+
+        report["adjusted_rand_index"] = adjusted_rand_score(
+            assignments["full"], assignments["reduced"]
+        )
+        report["normalized_mutual_info"] = normalized_mutual_info_score(
+            assignments["full"], assignments["reduced"]
+        )
+
+        for key, value in report.items():
+            if isinstance(value, float):
+                value = f"{value:.4f}"
+            print(f"{key}: {value}")
+
+        return report
+
+
+def description_hash(company: dict) -> str:
+    return hashlib.sha256((company["description"] or "").encode("utf-8")).hexdigest()
+
+
+def get_cleaned_topic_names(topic_model: BERTopic) -> typing.Dict[int, str]:
+    topic_info = topic_model.get_topic_info()
+    return {
+        int(topic_id): clean_topic_name(clean_topic_name(name))
+        for topic_id, name in zip(topic_info["Topic"], topic_info["Name"])
+    }
+
+
+def assign_topics(
+    companies_list_of_dicts: list,
+    topics: typing.Sequence[int],
+    probabilities: typing.Sequence[typing.Optional[float]],
+    cleaned_topic_names: typing.Dict[int, str],
+):
+    for company, topic_id, probability in zip(
+        companies_list_of_dicts, topics, probabilities
+    ):
+        company["derived_topic_id"] = int(topic_id)
+        company["derived_topic"] = cleaned_topic_names.get(int(topic_id))
+        company["derived_topic_probability"] = (
+            float(probability) if probability is not None else None
+        )
+
+
+def nearest_topics(
+    topic_model: BERTopic, embeddings: np.ndarray
+) -> typing.Tuple[np.ndarray, np.ndarray]:
+    """
+    Closest non-outlier topic of each embedding by cosine similarity to the topic
+    embeddings, which is how a safetensors-loaded BERTopic model transforms
+    """
+    topic_ids = np.array(sorted(topic_model.topic_sizes_.keys()))
+    topic_embeddings = np.asarray(topic_model.topic_embeddings_, dtype=np.float32)
+
+    keep = topic_ids >= 0
+    topic_ids = topic_ids[keep]
+    topic_embeddings = topic_embeddings[keep]
+
+    topic_embeddings = topic_embeddings / np.maximum(
+        np.linalg.norm(topic_embeddings, axis=1, keepdims=True), 1e-12
+    )
+    embeddings = embeddings / np.maximum(
+        np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12
+    )
+
+    similarities = embeddings @ topic_embeddings.T
+    best = np.argmax(similarities, axis=1)
+
+    return topic_ids[best], similarities[np.arange(len(best)), best]
+
+
+def build_topic_model(
+    calculate_probabilities: bool = True,
+    min_topic_size: int = 10,
+    nr_topics: typing.Union[int, str, None] = "auto",
+    umap_model: typing.Optional[CachedReducer] = None,
+) -> BERTopic:
+    return BERTopic(
+        min_topic_size=min_topic_size,
+        calculate_probabilities=calculate_probabilities,
+        verbose=True,
+        nr_topics=nr_topics,
+        umap_model=umap_model or CachedReducer(),
+    )
+
+
+def stack_embeddings(embeddings) -> np.ndarray:
+    """
+    Build the float32 matrix UMAP expects, float16 embeddings are only widened here
+    """
+    if isinstance(embeddings, np.ndarray):
+        return embeddings.astype(np.float32, copy=False)
+
+    return np.stack(embeddings).astype(np.float32, copy=False)
+
+
+def neighbour_overlap(
+    full_embeddings: np.ndarray,
+    reduced_embeddings: np.ndarray,
+    k: int = 10,
+    sample_size: int = 2_000,
+    block_size: int = 256,
+) -> float:
+    """
+    Mean share of each sampled company's k nearest neighbours (cosine) that are
+    the same with the full and the reduced embeddings
+    """
+    count = full_embeddings.shape[0]
+    k = min(k, count - 1)
+    if k <= 0:
+        return 1.0
+
+    rng = np.random.default_rng(0)
+    sample = rng.choice(count, size=min(sample_size, count), replace=False)
+
+    def neighbours(embeddings: np.ndarray, rows: np.ndarray) -> np.ndarray:
+        embeddings = stack_embeddings(embeddings)
+        embeddings = embeddings / np.maximum(
+            np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12
+        )
+        result = []
+
+        for i in range(0, len(rows), block_size):
+            block = rows[i : i + block_size]
+            scores = embeddings[block] @ embeddings.T
+            scores[np.arange(len(block)), block] = -np.inf
+            result.append(np.argpartition(-scores, k, axis=1)[:, :k])
+
+        return np.vstack(result)
+
+    full_neighbours = neighbours(full_embeddings, sample)
+    reduced_neighbours = neighbours(reduced_embeddings, sample)
 
-        return cleaned_topic_names
+    overlaps = [
+        len(set(full_row) & set(reduced_row)) / k
+        for full_row, reduced_row in zip(full_neighbours, reduced_neighbours)
+    ]
+    return float(np.mean(overlaps))
 
 
 def clean_topic_name(topic_name):
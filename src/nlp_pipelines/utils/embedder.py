@@ -1,11 +1,20 @@
+import concurrent.futures
+import functools
 import os
+import random
 import re
+import threading
 import time
+import typing
 
+import numpy as np
+import openai
 import tiktoken
 from dotenv import load_dotenv
 from openai import OpenAI
 
+from .embedding_cache import EmbeddingCache
+
 load_dotenv()
 
 
@@ -14,51 +23,369 @@ openAI_client = OpenAI(
     api_key=openai_api_key,
 )
 
+# Per-request limits of the OpenAI embedding models
+EMBEDDING_MODEL_LIMITS = {
+    "text-embedding-3-large": {
+        "max_input_tokens": 8191,
+        "max_request_tokens": 300_000,
+        "max_inputs": 2048,
+    },
+    "text-embedding-3-small": {
+        "max_input_tokens": 8191,
+        "max_request_tokens": 300_000,
+        "max_inputs": 2048,
+    },
+    "text-embedding-ada-002": {
+        "max_input_tokens": 8191,
+        "max_request_tokens": 300_000,
+        "max_inputs": 2048,
+    },
+}
+
+EMBEDDING_TOKENS_PER_MINUTE = int(os.getenv("EMBEDDING_TOKENS_PER_MINUTE", 1_000_000))
+EMBEDDING_MAX_IN_FLIGHT = int(os.getenv("EMBEDDING_MAX_IN_FLIGHT", 8))
+
+# Shortened embeddings (e.g. 256, 1024), unset keeps the model's full size
+EMBEDDING_DIMENSIONS = int(os.getenv("EMBEDDING_DIMENSIONS", 0)) or None
+EMBEDDING_DTYPE = os.getenv("EMBEDDING_DTYPE", "float32")
+
 
 class EmbeddingPipeline:
     """
     Class to get the embeddings from the companies
     """
 
-    def __init__(self):
-        pass
+    def __init__(
+        self,
+        model_name: str = "text-embedding-3-large",
+        cache: typing.Optional[EmbeddingCache] = None,
+        use_cache: bool = True,
+        dimensions: typing.Optional[int] = EMBEDDING_DIMENSIONS,
+        truncate_locally: bool = False,
+        dtype: str = EMBEDDING_DTYPE,
+    ):
+        """
+        :param dimensions: Size of the embeddings, None keeps the model's full size.
+        :param truncate_locally: Request full embeddings (sharing the cache with the
+            full size runs) and truncate/renormalize them locally, instead of asking
+            the API for shortened embeddings.
+        :param dtype: "float32" or "float16" storage of the embedding matrix.
+        """
+        if cache is None and use_cache:
+            cache = EmbeddingCache()
+
+        self.model_name = model_name
+        self.cache = cache
+        self.dimensions = dimensions
+        self.truncate_locally = truncate_locally
+        self.dtype = np.dtype(dtype)
+
+        # Dimensions sent to the API, None requests the full vectors
+        self.api_dimensions = None if truncate_locally else dimensions
+        self.scheduler = EmbeddingScheduler(model_name, dimensions=self.api_dimensions)
+
+    def embed_texts(
+        self,
+        texts: typing.List[str],
+        token_counts: typing.Optional[typing.List[int]] = None,
+    ) -> typing.Tuple[np.ndarray, np.ndarray]:
+        """
+        Embed cleaned texts into a single (n, dimensions) matrix
+
+        :return: The embedding matrix and a boolean mask of the rows that could be
+            embedded, failed rows are left at zero.
+        """
+        matrix, mask, _ = self._embed(texts, token_counts)
+        return matrix, mask
+
+    def _embed(
+        self,
+        texts: typing.List[str],
+        token_counts: typing.Optional[typing.List[int]] = None,
+    ) -> typing.Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Same as embed_texts, with a third boolean mask of the rows the API embedded
+        in this call instead of the cache
+        """
+        if token_counts is None:
+            token_counts = count_tokens_batch(texts, self.model_name)
+
+        # Only the texts missing from the cache are sent to the API
+        if self.cache is not None:
+            embeddings = self.cache.get_many(
+                texts, self.model_name, self.api_dimensions
+            )
+        else:
+            embeddings = [None] * len(texts)
+
+        missing_indexes = [
+            i for i, embedding in enumerate(embeddings) if embedding is None
+        ]
+        missing_texts = [texts[i] for i in missing_indexes]
+
+        new_embeddings = self.scheduler.embed(
+            missing_texts, [token_counts[i] for i in missing_indexes]
+        )
 
-    def get_embeddings_from_objetcs(self, companies_list_of_dicts: list):
-        for company in companies_list_of_dicts:
-            if not company["description"]:
-                company["description"] = "no description"
+        if self.cache is not None:
+            self.cache.put_many(
+                missing_texts, new_embeddings, self.model_name, self.api_dimensions
+            )
+            self.cache.report()
 
-            company["description"] = minimal_text_preprocessing(company["description"])
+        computed = np.zeros(len(texts), dtype=bool)
 
-        cleaned_descriptions = [
-            company["description"] for company in companies_list_of_dicts
-        ]
-        chunk_size = 500
+        for i, embedding in zip(missing_indexes, new_embeddings):
+            embeddings[i] = embedding
+            computed[i] = embedding is not None
 
-        # Initialize an empty list to store all embeddings
-        all_embeddings = []
+        sizes = [len(embedding) for embedding in embeddings if embedding is not None]
+        if not sizes:
+            return (
+                np.empty((len(texts), 0), dtype=self.dtype),
+                np.zeros(len(texts), dtype=bool),
+                computed,
+            )
 
-        # Process the cleaned descriptions in chunks
-        for i in range(0, len(cleaned_descriptions), chunk_size):
-            # Get the current chunk of descriptions
-            chunk = cleaned_descriptions[i : i + chunk_size]
+        dimensions = sizes[0]
+        if self.truncate_locally and self.dimensions:
+            dimensions = min(dimensions, self.dimensions)
 
-            # Get embeddings for the current chunk
-            chunk_embeddings = get_embeddings_from_list_of_texts(chunk)
+        matrix = np.zeros((len(texts), dimensions), dtype=self.dtype)
+        mask = np.zeros(len(texts), dtype=bool)
 
-            # Append the chunk embeddings to the all_embeddings list
-            all_embeddings.extend(chunk_embeddings)
+        for i, embedding in enumerate(embeddings):
+            if embedding is None:
+                continue
 
-        if not all_embeddings:
+            embedding = np.asarray(embedding, dtype=np.float32)
+            if embedding.shape[0] != dimensions:
+                embedding = truncate_and_normalize(embedding, dimensions)
+
+            matrix[i] = embedding
+            mask[i] = True
+
+        return matrix, mask, computed
+
+    def get_embeddings_from_objects(self, companies_list_of_dicts: list):
+        cleaned_descriptions, token_counts = preprocess_texts(
+            [
+                company["description"] or "no description"
+                for company in companies_list_of_dicts
+            ],
+            self.model_name,
+        )
+
+        for company, description in zip(companies_list_of_dicts, cleaned_descriptions):
+            company["description"] = description
+
+        matrix, mask, computed = self._embed(cleaned_descriptions, token_counts)
+
+        if not mask.any():
             print("No embeddings found")
             return None
-        all_embeddings = [embedding.embedding for embedding in all_embeddings]
-        for company, embedding in zip(companies_list_of_dicts, all_embeddings):
-            company["description_embeddings"] = embedding
+
+        # Rows are views on the matrix, no per-float Python objects are created.
+        # "embedding_computed" tells new or changed descriptions from cached ones.
+        for i, company in enumerate(companies_list_of_dicts):
+            company["description_embeddings"] = matrix[i] if mask[i] else None
+            company["embedding_computed"] = bool(computed[i])
 
         return companies_list_of_dicts
 
 
+def truncate_and_normalize(embeddings: np.ndarray, dimensions: int) -> np.ndarray:
+    """
+    Keep the first `dimensions` components of one or several embeddings and scale
+    them back to unit length, as the API does for shortened embeddings
+    """
+    embeddings = np.asarray(embeddings)[..., :dimensions]
+    norms = np.linalg.norm(embeddings, axis=-1, keepdims=True)
+    return embeddings / np.maximum(norms, 1e-12)
+
+
+class TokenBudget:
+    """
+    Tokens-per-minute budget shared by the in-flight embedding requests
+    """
+
+    def __init__(self, tokens_per_minute: int):
+        self.capacity = tokens_per_minute
+        self.rate = tokens_per_minute / 60
+        self.tokens = float(tokens_per_minute)
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, tokens: int):
+        tokens = min(tokens, self.capacity)
+
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.capacity, self.tokens + (now - self.updated_at) * self.rate
+                )
+                self.updated_at = now
+
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return
+
+                wait = (tokens - self.tokens) / self.rate
+
+            time.sleep(wait)
+
+
+class EmbeddingScheduler:
+    """
+    Embed large lists of texts with requests packed up to the model limits,
+    several of them in flight under a tokens-per-minute budget
+    """
+
+    def __init__(
+        self,
+        model_name: str = "text-embedding-3-large",
+        tokens_per_minute: int = EMBEDDING_TOKENS_PER_MINUTE,
+        max_in_flight: int = EMBEDDING_MAX_IN_FLIGHT,
+        max_retries: int = 5,
+        dimensions: typing.Optional[int] = None,
+    ):
+        limits = EMBEDDING_MODEL_LIMITS.get(
+            model_name, EMBEDDING_MODEL_LIMITS["text-embedding-3-large"]
+        )
+
+        self.model_name = model_name
+        self.max_input_tokens = limits["max_input_tokens"]
+        self.max_request_tokens = min(limits["max_request_tokens"], tokens_per_minute)
+        self.max_inputs = limits["max_inputs"]
+        self.max_in_flight = max_in_flight
+        self.max_retries = max_retries
+        self.dimensions = dimensions
+        self.budget = TokenBudget(tokens_per_minute)
+
+    def pack(self, token_counts: typing.List[int]) -> typing.List[typing.List[int]]:
+        """
+        Group text indexes into batches under the per-request token and input limits
+        """
+        batches = []
+        batch: typing.List[int] = []
+        batch_tokens = 0
+
+        for i, tokens in enumerate(token_counts):
+            if batch and (
+                batch_tokens + tokens > self.max_request_tokens
+                or len(batch) >= self.max_inputs
+            ):
+                batches.append(batch)
+                batch = []
+                batch_tokens = 0
+
+            batch.append(i)
+            batch_tokens += tokens
+
+        if batch:
+            batches.append(batch)
+
+        return batches
+
+    def _request(self, texts: typing.List[str]) -> typing.List[typing.List[float]]:
+        kwargs = {}
+        if self.dimensions:
+            kwargs["dimensions"] = self.dimensions
+
+        response = openAI_client.embeddings.create(
+            model=self.model_name, input=texts, encoding_format="float", **kwargs
+        )
+        return [item.embedding for item in sorted(response.data, key=lambda d: d.index)]
+
+    def _embed_batch(
+        self, texts: typing.List[str], tokens: typing.List[int]
+    ) -> typing.List[typing.Optional[typing.List[float]]]:
+        for attempt in range(self.max_retries + 1):
+            self.budget.acquire(sum(tokens))
+
+            try:
+                return self._request(texts)
+            except (openai.AuthenticationError, openai.PermissionDeniedError):
+                # Every other batch would fail the same way
+                raise
+            except openai.BadRequestError as e:
+                # An input was rejected, split the batch so it does not lose the others
+                if len(texts) == 1:
+                    print(f"An input could not be embedded: {e}")
+                    return [None]
+
+                middle = len(texts) // 2
+                return self._embed_batch(
+                    texts[:middle], tokens[:middle]
+                ) + self._embed_batch(texts[middle:], tokens[middle:])
+            except Exception as e:
+                # Rate limits, timeouts and server errors, the whole batch is retried
+                if attempt == self.max_retries:
+                    print(f"An error occurred while fetching embeddings: {e}")
+                    break
+
+                delay = random.uniform(0, min(60, 2**attempt))
+                print(
+                    f"Embedding batch of {len(texts)} texts failed ({e}), "
+                    f"retrying in {delay:.1f}s"
+                )
+                time.sleep(delay)
+
+        return [None] * len(texts)
+
+    def embed(
+        self,
+        texts: typing.List[str],
+        token_counts: typing.Optional[typing.List[int]] = None,
+    ) -> typing.List[typing.Optional[typing.List[float]]]:
+        """
+        Return one embedding per text in the input order, None for texts that
+        still failed after every retry
+        """
+        if not texts:
+            return []
+
+        if token_counts is None:
+            token_counts = count_tokens_batch(texts, self.model_name)
+
+        texts = list(texts)
+        token_counts = list(token_counts)
+
+        for i, tokens in enumerate(token_counts):
+            if tokens > self.max_input_tokens:
+                print(f"Warning: truncating a text of {tokens} tokens")
+                texts[i] = truncate_tokens(texts[i], self.max_input_tokens)
+                token_counts[i] = self.max_input_tokens
+
+        batches = self.pack(token_counts)
+        embeddings: typing.List[typing.Optional[typing.List[float]]] = [None] * len(
+            texts
+        )
+
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.max_in_flight
+        ) as executor:
+            futures = {
+                executor.submit(
+                    self._embed_batch,
+                    [texts[i] for i in batch],
+                    [token_counts[i] for i in batch],
+                ): batch
+                for batch in batches
+            }
+
+            for future in concurrent.futures.as_completed(futures):
+                for i, embedding in zip(futures[future], future.result()):
+                    embeddings[i] = embedding
+
+        failed = sum(embedding is None for embedding in embeddings)
+        if failed:
+            print(f"Warning: {failed} texts could not be embedded")
+
+        return embeddings
+
+
 def get_embeddings_from_list_of_texts_with_rate_limit(
     texts: list,
     model_name: str = "text-embedding-3-large",
@@ -130,14 +457,39 @@ def get_embeddings_from_list_of_texts_with_rate_limit(
     return all_embeddings
 
 
-def count_tokens(text: str, model_name: str = "text-embedding-3-large") -> int:
-    """Return the approximate number of tokens for the given text."""
+@functools.lru_cache(maxsize=None)
+def get_encoding(model_name: str = "text-embedding-3-large") -> tiktoken.Encoding:
+    """Return the tiktoken encoding of a model, loaded once per process."""
     try:
-        encoding = tiktoken.encoding_for_model(model_name)
+        return tiktoken.encoding_for_model(model_name)
     except KeyError:
         # Fallback if a direct encoding isn't found for the model
-        encoding = tiktoken.get_encoding("cl100k_base")
-    return len(encoding.encode(text))
+        return tiktoken.get_encoding("cl100k_base")
+
+
+def count_tokens(text: str, model_name: str = "text-embedding-3-large") -> int:
+    """Return the approximate number of tokens for the given text."""
+    return len(get_encoding(model_name).encode_ordinary(text))
+
+
+def count_tokens_batch(
+    texts: typing.List[str], model_name: str = "text-embedding-3-large"
+) -> typing.List[int]:
+    """Return the number of tokens of each text, encoded in one batch."""
+    encoded = get_encoding(model_name).encode_ordinary_batch(texts)
+    return [len(tokens) for tokens in encoded]
+
+
+def truncate_tokens(
+    text: str, max_tokens: int, model_name: str = "text-embedding-3-large"
+) -> str:
+    """Cut a text down to its first `max_tokens` tokens."""
+    encoding = get_encoding(model_name)
+    return encoding.decode(encoding.encode_ordinary(text)[:max_tokens])
+
+
+HTML_TAG_PATTERN = re.compile(r"<[^>]*>")
+URL_PATTERN = re.compile(r"http\S+|www\.\S+")
 
 
 def minimal_text_preprocessing(text):
@@ -154,10 +506,10 @@ def minimal_text_preprocessing(text):
     if text is None:
         return "no description"
     # 1. Remove HTML tags
-    text = re.sub(r"<[^>]*>", "", text)
+    text = HTML_TAG_PATTERN.sub("", text)
 
     # 2. Remove URLs
-    text = re.sub(r"http\S+|www\.\S+", "", text)
+    text = URL_PATTERN.sub("", text)
 
     # 3. Replace multiple spaces/tabs/newlines with a single space
     text = " ".join(text.split())
@@ -165,10 +517,59 @@ def minimal_text_preprocessing(text):
     return text
 
 
-def get_embeddings_from_list_of_texts(text: list):
+def _preprocess_chunk(
+    texts: typing.List[typing.Optional[str]], model_name: str
+) -> typing.Tuple[typing.List[str], typing.List[int]]:
+    cleaned = [minimal_text_preprocessing(text) for text in texts]
+    return cleaned, count_tokens_batch(cleaned, model_name)
+
+
+def preprocess_texts(
+    texts: typing.List[typing.Optional[str]],
+    model_name: str = "text-embedding-3-large",
+    workers: typing.Optional[int] = None,
+    chunk_size: int = 2_000,
+) -> typing.Tuple[typing.List[str], typing.List[int]]:
+    """
+    Clean a large corpus (descriptions, READMEs, news bodies...) and count the
+    tokens of every cleaned text in a single pass.
+
+    :param texts: Raw texts, None is replaced by "no description".
+    :param model_name: Model whose tokenizer is used to count tokens.
+    :param workers: Number of worker processes, defaults to the number of CPUs.
+        Small corpora are processed in the current process.
+    :param chunk_size: Number of texts sent to a worker at once.
+    :return: The cleaned texts and their token counts, in the input order.
+    """
+    workers = workers or os.cpu_count() or 1
+    chunks = [texts[i : i + chunk_size] for i in range(0, len(texts), chunk_size)]
+
+    if workers == 1 or len(chunks) <= 1:
+        results = [_preprocess_chunk(chunk, model_name) for chunk in chunks]
+    else:
+        with concurrent.futures.ProcessPoolExecutor(
+            max_workers=min(workers, len(chunks))
+        ) as executor:
+            results = list(
+                executor.map(_preprocess_chunk, chunks, [model_name] * len(chunks))
+            )
+
+    cleaned_texts = []
+    token_counts = []
+
+    for cleaned, counts in results:
+        cleaned_texts.extend(cleaned)
+        token_counts.extend(counts)
+
+    return cleaned_texts, token_counts
+
+
+def get_embeddings_from_list_of_texts(
+    text: list, model_name: str = "text-embedding-3-large"
+):
     try:
         embeddings = openAI_client.embeddings.create(
-            model="text-embedding-3-large", input=text, encoding_format="float"
+            model=model_name, input=text, encoding_format="float"
         )
         return embeddings.data
     except Exception as e:
@@ -0,0 +1,109 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import typing
+
+import numpy as np
+
+DEFAULT_CACHE_PATH = os.getenv("EMBEDDING_CACHE_PATH", ".cache/embeddings.sqlite3")
+
+
+class EmbeddingCache:
+    """
+    Persistent embedding store keyed by (model, dimensions, hash of the preprocessed
+    text), so unchanged descriptions are never sent to the API twice
+    """
+
+    def __init__(self, path: str = DEFAULT_CACHE_PATH):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute(
+            """
+            CREATE TABLE IF NOT EXISTS embeddings (
+                key TEXT PRIMARY KEY,
+                model TEXT NOT NULL,
+                dimensions INTEGER NOT NULL,
+                embedding BLOB NOT NULL
+            )
+            """
+        )
+        self.connection.commit()
+
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(text: str, model_name: str, dimensions: typing.Optional[int]) -> str:
+        text_hash = hashlib.sha256(text.encode("utf-8")).hexdigest()
+        return f"{model_name}:{dimensions or 0}:{text_hash}"
+
+    def get_many(
+        self,
+        texts: typing.List[str],
+        model_name: str,
+        dimensions: typing.Optional[int] = None,
+    ) -> typing.List[typing.Optional[np.ndarray]]:
+        """
+        Return the cached float32 embedding of each text, None for cache misses
+        """
+        keys = [self.key(text, model_name, dimensions) for text in texts]
+        found = {}
+
+        with self.lock:
+            # Stay under the SQLite bound parameter limit
+            for i in range(0, len(keys), 500):
+                chunk = keys[i : i + 500]
+                placeholders = ",".join("?" * len(chunk))
+                rows = self.connection.execute(
+                    "SELECT key, embedding FROM embeddings "
+                    f"WHERE key IN ({placeholders})",
+                    chunk,
+                )
+                for key, blob in rows:
+                    found[key] = np.frombuffer(blob, dtype=np.float32)
+
+        embeddings = [found.get(key) for key in keys]
+
+        hits = sum(embedding is not None for embedding in embeddings)
+        self.hits += hits
+        self.misses += len(embeddings) - hits
+
+        return embeddings
+
+    def put_many(
+        self,
+        texts: typing.List[str],
+        embeddings: typing.List[typing.Optional[typing.Sequence[float]]],
+        model_name: str,
+        dimensions: typing.Optional[int] = None,
+    ):
+        rows = [
+            (
+                self.key(text, model_name, dimensions),
+                model_name,
+                dimensions or 0,
+                np.asarray(embedding, dtype=np.float32).tobytes(),
+            )
+            for text, embedding in zip(texts, embeddings)
+            if embedding is not None
+        ]
+
+        with self.lock:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?, ?)", rows
+            )
+            self.connection.commit()
+
+    def report(self):
+        total = self.hits + self.misses
+        hit_rate = self.hits / total * 100 if total else 0.0
+        print(
+            f"Embedding cache: {self.hits} hits, {self.misses} misses "
+            f"({hit_rate:.1f}% hit rate)"
+        )
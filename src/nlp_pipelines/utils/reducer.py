@@ -0,0 +1,209 @@
+import hashlib
+import json
+import os
+import time
+import typing
+
+import joblib
+import numpy as np
+from sklearn.decomposition import PCA
+from umap import UMAP
+
+REDUCTION_CACHE_DIR = os.getenv("REDUCTION_CACHE_DIR", ".cache/reduced")
+
+# Optional PCA step before UMAP, unset runs UMAP on the raw embeddings
+PCA_COMPONENTS = int(os.getenv("UMAP_PCA_COMPONENTS", 0)) or None
+
+UMAP_N_JOBS = int(os.getenv("UMAP_N_JOBS", -1))
+
+# Also cache the fitted PCA and UMAP models, only needed to transform new data
+# later. A pickled UMAP holds the whole input matrix, so this is off by default.
+CACHE_MODELS = os.getenv("REDUCTION_CACHE_MODELS", "false").lower() in (
+    "1",
+    "true",
+    "yes",
+)
+
+# Cached reductions kept, the least recently used ones are deleted
+CACHE_MAX_ENTRIES = int(os.getenv("REDUCTION_CACHE_MAX_ENTRIES", 8))
+
+
+class CachedReducer:
+    """
+    Dimensionality reduction stage (optional PCA then UMAP) whose reduced
+    coordinates are cached on disk as .npy files, keyed by a hash of the embedding
+    matrix and of the reduction parameters. The fitted models are only cached with
+    `cache_models`, and at most `max_entries` reductions are kept.
+
+    It is passed to BERTopic as `umap_model`, so trying other HDBSCAN or topic
+    parameters on the same embeddings skips the reduction entirely.
+    """
+
+    def __init__(
+        self,
+        n_components: int = 5,
+        n_neighbors: int = 15,
+        min_dist: float = 0.0,
+        metric: str = "cosine",
+        pca_components: typing.Optional[int] = PCA_COMPONENTS,
+        n_jobs: int = UMAP_N_JOBS,
+        low_memory: bool = True,
+        cache_dir: typing.Optional[str] = REDUCTION_CACHE_DIR,
+        cache_models: bool = CACHE_MODELS,
+        max_entries: int = CACHE_MAX_ENTRIES,
+        mmap: bool = False,
+    ):
+        """
+        :param mmap: Map cached coordinates read-only instead of reading them, for
+            processes sharing the same reduction.
+        """
+        self.params = {
+            "n_components": n_components,
+            "n_neighbors": n_neighbors,
+            "min_dist": min_dist,
+            "metric": metric,
+            "pca_components": pca_components,
+            "low_memory": low_memory,
+        }
+        self.n_jobs = n_jobs
+        self.cache_dir = cache_dir
+        self.cache_models = cache_models
+        self.max_entries = max_entries
+        self.mmap = mmap
+
+        self.pca: typing.Optional[PCA] = None
+        self.umap: typing.Optional[UMAP] = None
+        self.key: typing.Optional[str] = None
+        self.embedding_: typing.Optional[np.ndarray] = None
+
+    def cache_key(self, embeddings: np.ndarray) -> str:
+        digest = hashlib.sha256()
+        digest.update(json.dumps(self.params, sort_keys=True).encode("utf-8"))
+        digest.update(str(embeddings.shape).encode("utf-8"))
+
+        # Hash in blocks, a memory-mapped matrix is never copied whole
+        for i in range(0, embeddings.shape[0], 10_000):
+            block = np.ascontiguousarray(embeddings[i : i + 10_000], dtype=np.float32)
+            digest.update(block.tobytes())
+
+        return digest.hexdigest()
+
+    def fit(self, embeddings: np.ndarray, y=None) -> "CachedReducer":
+        """
+        Fit PCA and UMAP, or load their output from the cache. Cached models are
+        only loaded by transform, when new embeddings need them.
+        """
+        self.key = self.cache_key(embeddings)
+        self.pca = None
+        self.umap = None
+        path = self._path(self.key)
+
+        if path and os.path.exists(f"{path}.npy"):
+            self.embedding_ = np.load(
+                f"{path}.npy", mmap_mode="r" if self.mmap else None
+            )
+
+            # Mark the entry as recently used for the eviction
+            os.utime(f"{path}.npy")
+            print(f"Loaded reduced embeddings from {path}.npy")
+            return self
+
+        start = time.time()
+        reduced = embeddings
+
+        if self.params["pca_components"]:
+            self.pca = PCA(
+                n_components=self.params["pca_components"], svd_solver="randomized"
+            )
+            reduced = self.pca.fit_transform(embeddings)
+
+        # No random_state, a fixed seed forces UMAP to run on a single thread
+        self.umap = UMAP(
+            n_components=self.params["n_components"],
+            n_neighbors=self.params["n_neighbors"],
+            min_dist=self.params["min_dist"],
+            metric=self.params["metric"],
+            low_memory=self.params["low_memory"],
+            n_jobs=self.n_jobs,
+        )
+        self.embedding_ = self.umap.fit_transform(reduced, y=y)
+
+        print(
+            f"Reduced {embeddings.shape[0]} embeddings from {embeddings.shape[1]} to "
+            f"{self.params['n_components']} dimensions in {time.time() - start:.2f}s"
+        )
+
+        if path:
+            self._save(path)
+
+        return self
+
+    def transform(self, embeddings: np.ndarray) -> np.ndarray:
+        # BERTopic transforms the embeddings it was just fitted on, reuse them
+        if self.embedding_ is not None and self.cache_key(embeddings) == self.key:
+            return self.embedding_
+
+        path = self._path(self.key) if self.key else None
+
+        if self.umap is None and path and os.path.exists(f"{path}.models.joblib"):
+            self.pca, self.umap = joblib.load(f"{path}.models.joblib")
+
+        if self.umap is None:
+            raise ValueError(
+                "The reduction was loaded from the cache without its models, "
+                "set REDUCTION_CACHE_MODELS=1 to transform new embeddings"
+            )
+
+        if self.pca is not None:
+            embeddings = self.pca.transform(embeddings)
+
+        return self.umap.transform(embeddings)
+
+    def fit_transform(self, embeddings: np.ndarray, y=None) -> np.ndarray:
+        return self.fit(embeddings, y=y).embedding_
+
+    def _path(self, key: str) -> typing.Optional[str]:
+        if not self.cache_dir:
+            return None
+
+        return os.path.join(self.cache_dir, key)
+
+    def _save(self, path: str):
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+        # Written under a temporary name, a worker never maps a partial file
+        np.save(f"{path}.tmp.npy", np.asarray(self.embedding_, dtype=np.float32))
+        os.replace(f"{path}.tmp.npy", f"{path}.npy")
+
+        if self.cache_models:
+            joblib.dump((self.pca, self.umap), f"{path}.models.joblib")
+
+        self._evict()
+
+    def _evict(self):
+        """
+        Delete the least recently used reductions beyond `max_entries`
+        """
+        entries = sorted(
+            (
+                os.path.join(self.cache_dir, name)
+                for name in os.listdir(self.cache_dir)
+                if name.endswith(".npy") and not name.endswith(".tmp.npy")
+            ),
+            key=os.path.getmtime,
+            reverse=True,
+        )
+
+        for entry in entries[self.max_entries :]:
+            path = entry[: -len(".npy")]
+
+            for stale in (entry, f"{path}.models.joblib"):
+                if os.path.exists(stale):
+                    os.remove(stale)
+
+            print(f"Evicted the cached reduction {path}")
+
+        # Whole pickled reducers of the previous cache format
+        for name in os.listdir(self.cache_dir):
+            if name.endswith(".joblib") and not name.endswith(".models.joblib"):
+                os.remove(os.path.join(self.cache_dir, name))
@@ -0,0 +1,356 @@
+import json
+import os
+import time
+import typing
+
+import numpy as np
+import sqlalchemy
+
+import src.utils as utils
+from src.utils.bulk_copy import copy_upsert
+
+try:
+    import hnswlib
+except ImportError:
+    hnswlib = None
+
+db = utils.db
+
+SIMILARITY_INDEX_PATH = os.getenv("SIMILARITY_INDEX_PATH", ".cache/similarity_index")
+
+# Memory the NumPy fallback may use to score one block of rows
+SCORE_MEMORY_BYTES = int(os.getenv("SIMILARITY_SCORE_MEMORY_MB", 256)) * 2**20
+
+# Queries scored together by the NumPy fallback, the blocks are sized from them
+QUERY_BATCH_SIZE = 1_024
+
+
+class SimilarityIndex:
+    """
+    Approximate nearest neighbour index over the description embeddings, to find
+    "companies like X" by company id or free text.
+
+    Uses an HNSW graph when hnswlib is installed, otherwise a flat int8 matrix
+    (one scale per vector, 4x smaller than float32) scored block by block in NumPy,
+    exact up to quantization. Both are persisted to `path` and accept incremental
+    inserts.
+    """
+
+    def __init__(
+        self,
+        dimensions: int,
+        path: str = SIMILARITY_INDEX_PATH,
+        backend: typing.Optional[str] = None,
+        max_elements: int = 100_000,
+        m: int = 16,
+        ef_construction: int = 200,
+        ef_search: int = 64,
+    ):
+        """
+        :param dimensions: Size of the embeddings.
+        :param path: Directory where the index is saved.
+        :param backend: "hnsw" or "int8", defaults to "hnsw" when hnswlib is
+            installed.
+        :param max_elements: Initial capacity of the HNSW graph, grown as needed.
+        :param m: HNSW links per node, more is more accurate and uses more memory.
+        :param ef_construction: HNSW build time accuracy.
+        :param ef_search: HNSW query time accuracy, must be at least k.
+        """
+        if backend is None:
+            backend = "hnsw" if hnswlib is not None else "int8"
+
+        if backend == "hnsw" and hnswlib is None:
+            raise ImportError("hnswlib is not installed, use the int8 backend")
+
+        self.dimensions = dimensions
+        self.path = path
+        self.backend = backend
+        self.ef_search = ef_search
+
+        self.ids: typing.List[str] = []
+        self.positions: typing.Dict[str, int] = {}
+
+        if backend == "hnsw":
+            self.index = hnswlib.Index(space="cosine", dim=dimensions)
+            self.index.init_index(
+                max_elements=max_elements, M=m, ef_construction=ef_construction
+            )
+            self.index.set_ef(ef_search)
+        else:
+            self.vectors = np.empty((0, dimensions), dtype=np.int8)
+            self.scales = np.empty(0, dtype=np.float32)
+
+    @classmethod
+    def load(cls, path: str = SIMILARITY_INDEX_PATH) -> "SimilarityIndex":
+        with open(os.path.join(path, "index.json")) as f:
+            meta = json.load(f)
+
+        index = cls(
+            meta["dimensions"],
+            path=path,
+            backend=meta["backend"],
+            max_elements=1,
+            ef_search=meta["ef_search"],
+        )
+        index.ids = meta["ids"]
+        index.positions = {company_id: i for i, company_id in enumerate(index.ids)}
+
+        if index.backend == "hnsw":
+            index.index.load_index(
+                os.path.join(path, "hnsw.bin"), max_elements=len(index.ids)
+            )
+            index.index.set_ef(index.ef_search)
+        else:
+            index.vectors = np.load(os.path.join(path, "vectors.npy"), mmap_mode="r")
+            index.scales = np.load(os.path.join(path, "scales.npy"))
+
+        return index
+
+    @classmethod
+    def load_or_create(
+        cls, dimensions: int, path: str = SIMILARITY_INDEX_PATH, **kwargs
+    ) -> "SimilarityIndex":
+        if os.path.exists(os.path.join(path, "index.json")):
+            index = cls.load(path)
+
+            if index.dimensions == dimensions:
+                return index
+
+            print(f"Index has {index.dimensions} dimensions, rebuilding it")
+
+        return cls(dimensions, path=path, **kwargs)
+
+    def save(self):
+        os.makedirs(self.path, exist_ok=True)
+
+        if self.backend == "hnsw":
+            self.index.save_index(os.path.join(self.path, "hnsw.bin"))
+        else:
+            np.save(os.path.join(self.path, "vectors.npy"), self.vectors)
+            np.save(os.path.join(self.path, "scales.npy"), self.scales)
+
+        with open(os.path.join(self.path, "index.json"), "w") as f:
+            json.dump(
+                {
+                    "backend": self.backend,
+                    "dimensions": self.dimensions,
+                    "ef_search": self.ef_search,
+                    "ids": self.ids,
+                },
+                f,
+            )
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def add(self, company_ids: typing.List[str], embeddings: np.ndarray):
+        """
+        Insert new companies and replace the vectors of the known ones
+        """
+        start = time.time()
+        embeddings = normalize(embeddings)
+
+        labels = []
+        for company_id in company_ids:
+            if company_id not in self.positions:
+                self.positions[company_id] = len(self.ids)
+                self.ids.append(company_id)
+            labels.append(self.positions[company_id])
+
+        labels = np.asarray(labels, dtype=np.int64)
+
+        if self.backend == "hnsw":
+            if len(self.ids) > self.index.get_max_elements():
+                self.index.resize_index(max(len(self.ids), 2 * len(self.ids)))
+
+            # Known labels are updated in place by hnswlib
+            self.index.add_items(embeddings, labels)
+        else:
+            if len(self.ids) > self.vectors.shape[0]:
+                grown = np.zeros((len(self.ids), self.dimensions), dtype=np.int8)
+                grown[: self.vectors.shape[0]] = self.vectors
+                self.vectors = grown
+                self.scales = np.resize(self.scales, len(self.ids))
+            elif not self.vectors.flags.writeable:
+                self.vectors = np.array(self.vectors)
+
+            self.vectors[labels], self.scales[labels] = quantize(embeddings)
+
+        print(
+            f"Indexed {len(company_ids)} embeddings ({len(self.ids)} total) "
+            f"in {time.time() - start:.2f}s"
+        )
+
+    def get_vector(self, company_id: str) -> typing.Optional[np.ndarray]:
+        position = self.positions.get(company_id)
+
+        if position is None:
+            return None
+
+        if self.backend == "hnsw":
+            return np.asarray(self.index.get_items([position]), dtype=np.float32)[0]
+
+        return self.vectors[position].astype(np.float32) * self.scales[position]
+
+    def query_vectors(
+        self, embeddings: np.ndarray, k: int = 10
+    ) -> typing.Tuple[np.ndarray, np.ndarray]:
+        """
+        Positions and cosine similarities of the k nearest companies of each query
+        """
+        embeddings = normalize(embeddings)
+        k = min(k, len(self.ids))
+
+        if k == 0:
+            empty = np.empty((embeddings.shape[0], 0))
+            return empty.astype(np.int64), empty.astype(np.float32)
+
+        if self.backend == "hnsw":
+            self.index.set_ef(max(self.ef_search, k))
+            labels, distances = self.index.knn_query(embeddings, k=k)
+            return labels, 1 - distances
+
+        if embeddings.shape[0] > QUERY_BATCH_SIZE:
+            results = [
+                self.query_vectors(embeddings[i : i + QUERY_BATCH_SIZE], k)
+                for i in range(0, embeddings.shape[0], QUERY_BATCH_SIZE)
+            ]
+            return (
+                np.vstack([labels for labels, _ in results]),
+                np.vstack([scores for _, scores in results]),
+            )
+
+        # About 32 bytes per scored cell (float32 scores and their copies, int64
+        # labels and argpartition indexes) plus the float32 copy of the block
+        block_size = max(
+            k,
+            SCORE_MEMORY_BYTES // (embeddings.shape[0] * 32 + self.dimensions * 4),
+        )
+
+        # Scores stay in float32, int8 products would overflow
+        best_scores = np.full((embeddings.shape[0], 0), -np.inf, dtype=np.float32)
+        best_labels = np.empty((embeddings.shape[0], 0), dtype=np.int64)
+
+        for i in range(0, len(self.ids), block_size):
+            block = self.vectors[i : i + block_size].astype(np.float32)
+            scores = (embeddings @ block.T) * self.scales[i : i + len(block)]
+            labels = np.broadcast_to(np.arange(i, i + len(block)), scores.shape)
+
+            scores = np.hstack([best_scores, scores])
+            labels = np.hstack([best_labels, labels])
+
+            top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+            best_scores = np.take_along_axis(scores, top, axis=1)
+            best_labels = np.take_along_axis(labels, top, axis=1)
+
+        order = np.argsort(-best_scores, axis=1)
+        return (
+            np.take_along_axis(best_labels, order, axis=1),
+            np.take_along_axis(best_scores, order, axis=1),
+        )
+
+    def similar(
+        self, company_id: str, k: int = 10
+    ) -> typing.List[typing.Tuple[str, float]]:
+        """
+        The k companies whose descriptions are closest to `company_id`
+        """
+        vector = self.get_vector(company_id)
+
+        if vector is None:
+            return []
+
+        labels, scores = self.query_vectors(vector[None, :], k + 1)
+        return [
+            (self.ids[label], float(score))
+            for label, score in zip(labels[0], scores[0])
+            if self.ids[label] != company_id
+        ][:k]
+
+    def search(
+        self, text: str, k: int = 10, embedding_pipeline=None
+    ) -> typing.List[typing.Tuple[str, float]]:
+        """
+        The k companies whose descriptions are closest to a free text query
+        """
+        if embedding_pipeline is None:
+            from .embedder import EmbeddingPipeline
+
+            embedding_pipeline = EmbeddingPipeline(dimensions=self.dimensions)
+
+        embeddings, mask = embedding_pipeline.embed_texts([text])
+
+        if not mask[0]:
+            return []
+
+        labels, scores = self.query_vectors(embeddings[:1], k)
+        return [
+            (self.ids[label], float(score))
+            for label, score in zip(labels[0], scores[0])
+        ]
+
+    def write_knn_table(
+        self, k: int = 10, table: str = "company_neighbours", batch_size: int = 10_000
+    ) -> int:
+        """
+        Precompute the k nearest neighbours of every company into `table`
+        """
+        with db.connection.begin() as connection:
+            connection.execute(
+                sqlalchemy.text(
+                    f"""
+                    CREATE TABLE IF NOT EXISTS {table} (
+                        company_id text NOT NULL REFERENCES companies(id)
+                            ON DELETE CASCADE ON UPDATE CASCADE,
+                        rank integer NOT NULL,
+                        neighbour_id text NOT NULL REFERENCES companies(id)
+                            ON DELETE CASCADE ON UPDATE CASCADE,
+                        score real NOT NULL,
+                        PRIMARY KEY (company_id, rank)
+                    )
+                    """
+                )
+            )
+
+        def rows():
+            for i in range(0, len(self.ids), batch_size):
+                company_ids = self.ids[i : i + batch_size]
+                vectors = np.stack(
+                    [self.get_vector(company_id) for company_id in company_ids]
+                )
+                labels, scores = self.query_vectors(vectors, k + 1)
+
+                for company_id, neighbours, neighbour_scores in zip(
+                    company_ids, labels, scores
+                ):
+                    neighbours = [
+                        (self.ids[label], score)
+                        for label, score in zip(neighbours, neighbour_scores)
+                        if self.ids[label] != company_id
+                    ][:k]
+
+                    for rank, (neighbour_id, score) in enumerate(neighbours, 1):
+                        yield company_id, rank, neighbour_id, float(score)
+
+        return copy_upsert(
+            table,
+            ["company_id", "rank", "neighbour_id", "score"],
+            rows(),
+            conflict_columns=["company_id", "rank"],
+        )
+
+
+def normalize(embeddings: np.ndarray) -> np.ndarray:
+    embeddings = np.atleast_2d(np.asarray(embeddings, dtype=np.float32))
+    return embeddings / np.maximum(
+        np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12
+    )
+
+
+def quantize(embeddings: np.ndarray) -> typing.Tuple[np.ndarray, np.ndarray]:
+    """
+    Map each vector to int8 with its own scale, so the largest component is 127
+    """
+    scales = np.maximum(np.abs(embeddings).max(axis=1), 1e-12) / 127
+    vectors = np.rint(embeddings / scales[:, None]).astype(np.int8)
+    return vectors, scales.astype(np.float32)
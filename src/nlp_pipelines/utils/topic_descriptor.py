@@ -1,26 +1,47 @@
+import concurrent.futures
+import hashlib
 import json
 import os
+import time
+import typing
 from collections import defaultdict
 
+import sqlalchemy
 from dotenv import load_dotenv
 from openai import OpenAI
-from sqlalchemy import Column, Integer, String, create_engine
-from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
 
-from utils.db import schema, session  # Import session and schema from db.py
+import src.utils as utils
+from src.utils.bulk_copy import copy_update
+from src.utils.state import StateFile
+from src.utils.topics import EXCLUDED_TOPIC_IDS
+
+from .embedder import count_tokens, truncate_tokens
+
+db = utils.db
 
 load_dotenv()
 
 openai_api_key = os.getenv("OPENAI_API_KEY")
 
-DATABASE_URL = os.getenv("DATABASE_URL")
-
 
 openAI_client = OpenAI(
     api_key=openai_api_key,
 )
 
+# Topics described per request, bounded by the prompt size and the answer size
+TOPIC_DESCRIPTION_CHUNK_SIZE = int(os.getenv("TOPIC_DESCRIPTION_CHUNK_SIZE", 20))
+TOPIC_DESCRIPTION_CHUNK_TOKENS = int(
+    os.getenv("TOPIC_DESCRIPTION_CHUNK_TOKENS", 12_000)
+)
+TOPIC_DESCRIPTION_CONCURRENCY = int(os.getenv("TOPIC_DESCRIPTION_CONCURRENCY", 4))
+
+# Longer company descriptions are cut, the first sentences carry the topic
+MAX_DESCRIPTION_TOKENS = 300
+
+TOPIC_DESCRIPTION_CACHE_PATH = os.getenv(
+    "TOPIC_DESCRIPTION_CACHE_PATH", ".cache/topic_descriptions.json"
+)
+
 
 class TopicDescriptor:
     """
@@ -36,110 +57,73 @@ class TopicDescriptor:
         """
         companies_with_topics_dicts = retrieve_companies_with_topics()
         topic_descriptions = build_topic_description_input(companies_with_topics_dicts)
-        result_descriptions = get_topic_description(topic_descriptions)
-        if result_descriptions.get("result"):
-            final_topics = topic_descriptions["result"]
-            Base = declarative_base()
-
-            engine = create_engine(
-                DATABASE_URL, echo=False
-            )  # Ensure DATABASE_URL is defined
-            Session = sessionmaker(bind=engine)
-
-            class Topic(Base):
-                __tablename__ = "topics"  # Ensure this matches your actual table name
-
-                id = Column(Integer, primary_key=True)
-                topic_name = Column(
-                    String, unique=True, nullable=False
-                )  # Ensure topic_name is unique
-                # topic_probability = Column(Float)  # Changed from Integer to Float
-                topic_description = Column(String)  # Added topic_description
+        final_topics = describe_topics(topic_descriptions)
 
+        if final_topics:
             # Perform the batch update by id
-            with Session() as session:
-                batch_update_topics_with_descriptions_by_id(
-                    session, final_topics, Topic, chunk_size=200
-                )
+            batch_update_topics_with_descriptions_by_id(final_topics)
 
 
-def retrieve_companies_with_topics():
+def retrieve_companies_with_topics(top_k: int = 5) -> typing.List[dict]:
     """
-    Retrieve the companies with topics from the database
+    Retrieve the top_k most probable companies of every topic, ranked in SQL so
+    only top_k rows per topic leave the database. EXCLUDED_TOPIC_IDS are curated by
+    hand and never described.
     """
-    # Map the tables to Python classes using schema from db.py
-    Companies = schema.classes.companies
-    Topics = schema.classes.topics
-
-    # Query to join companies and topics based on topic_id
-    def get_companies_with_topics():
-        return (
-            session.query(Companies, Topics)
-            .filter(Companies.topic_id == Topics.id)
-            .all()
-        )
-
-    # Example usage
-    companies_with_topics = get_companies_with_topics()
-
-    companies_with_topics_dicts = []
-    for company, topic in companies_with_topics:
-        company_dict = {
-            column.name: getattr(company, column.name)
-            for column in company.__table__.columns
-        }
-        company_dict["topic_name"] = topic.topic_name
-        companies_with_topics_dicts.append(company_dict)
+    query = sqlalchemy.text(
+        """
+        SELECT topic_id, topic_name, topic_probability, description
+        FROM (
+            SELECT
+                c.topic_id,
+                t.topic_name,
+                c.topic_probability,
+                c.description,
+                ROW_NUMBER() OVER (
+                    PARTITION BY c.topic_id
+                    ORDER BY c.topic_probability DESC NULLS LAST
+                ) AS rank
+            FROM companies c
+            JOIN topics t ON t.id = c.topic_id
+            WHERE NOT (c.topic_id = ANY(:excluded))
+        ) ranked
+        WHERE rank <= :top_k
+        ORDER BY topic_id, rank
+        """
+    )
 
-    return companies_with_topics_dicts
+    with db.connection.connect() as connection:
+        rows = connection.execute(
+            query, {"top_k": top_k, "excluded": EXCLUDED_TOPIC_IDS}
+        )
+        return [dict(row._mapping) for row in rows]
 
 
-def build_topic_description_input(companies_with_topics_dicts: list):
+def build_topic_description_input(companies_with_topics_dicts: list, top_k: int = 5):
     """
     Build the input for the topic description model
-    """
 
-    # 1. Group by topic_name
+    Given companies with a topic_id, topic_name and description, ordered by
+    topic_probability (descending) within each topic, return a list of dicts. Each
+    dict will contain the topic_id, topic_name, and up to top_k descriptions.
     """
-    Given a list of companies, each with a topic_id, topic_name, topic_probability,
-    and description, return a list of dicts. Each dict will contain the topic_id,
-    topic_name, and up to two highest-probability descriptions.
-    """
-    # 1. Group companies by (topic_id, topic_name)
+    # Group companies by (topic_id, topic_name), keeping their order
     topic_groups = defaultdict(list)
     for company in companies_with_topics_dicts:
         key = (company["topic_id"], company["topic_name"])
         topic_groups[key].append(company)
 
-    # 2. For each group, sort companies by topic_probability (descending)
     results = []
     for (topic_id, topic_name), group_companies in topic_groups.items():
-        # sort the group by topic_probability desc
-        sorted_group = sorted(
-            group_companies, key=lambda c: c["topic_probability"], reverse=True
-        )
+        topic = {"topic_id": topic_id, "topic_name": topic_name}
 
-        # pick top two (or fewer if the group has less than 2)
-        top_two = sorted_group[:5]
-
-        # we’ll store None if there is only one company in this topic
-        desc1 = top_two[0]["description"] if len(top_two) > 0 else None
-        desc2 = top_two[1]["description"] if len(top_two) > 1 else None
-        desc3 = top_two[2]["description"] if len(top_two) > 2 else None
-        desc4 = top_two[3]["description"] if len(top_two) > 3 else None
-        desc5 = top_two[4]["description"] if len(top_two) > 4 else None
-
-        results.append(
-            {
-                "topic_id": topic_id,
-                "topic_name": topic_name,
-                "company_description_1": desc1,
-                "company_description_2": desc2,
-                "company_description_3": desc3,
-                "company_description_4": desc4,
-                "company_description_5": desc5,
-            }
-        )
+        # None if there are fewer companies in this topic
+        for i in range(top_k):
+            topic[f"company_description_{i + 1}"] = (
+                group_companies[i]["description"] if i < len(group_companies) else None
+            )
+
+        results.append(topic)
 
     return results
 
@@ -149,10 +133,10 @@ def get_topic_description(
 ):
     system_prompt = "You will be provided with a list of dicts with a topic_id, topic title and up to 5 companies descriptions that regard that topic.\n"
     system_prompt += "Your task is to give a one line max description of the topic and in case rename the topic title based on the descriptions.\n"
-    system_prompt += "Please return a json with the following format: [{'topic_id': 'given_topic_id', 'new_topic_title': 'cleaned_topic_title', 'topic_description': 'description'}, {...}]"
+    system_prompt += "Please return a json with the following format: {'result': [{'topic_id': 'given_topic_id', 'new_topic_title': 'cleaned_topic_title', 'topic_description': 'description'}, {...}]}"
 
     prompt = f" This is the list of dicts with the topic title and the company descriptions from where you need to extrapolate a topic one line max description and clean  or rename the topic title: \n\n{topics_dicts}\n\n"
-    prompt += "Return a json with the following format:[{'topic_id': 'given_topic_id', 'new_topic_title': 'new_or_cleaned_topic_title', 'topic_description': 'description'}, {...}]\n"
+    prompt += "Return a json with the following format:{'result': [{'topic_id': 'given_topic_id', 'new_topic_title': 'new_or_cleaned_topic_title', 'topic_description': 'description'}, {...}]}\n"
 
     response = openAI_client.chat.completions.create(
         model=model,
@@ -170,67 +154,179 @@ def get_topic_description(
         return json.loads(response.choices[0].message.content)
     except json.JSONDecodeError:
         print("Error decoding JSON")
-        return {"classified_thesis": None, "confidence_score": None}
+        return {"result": None}
     except Exception as e:
         print(f"Error processing response: {e}")
-        return {"classified_thesis": None, "confidence_score": None}
+        return {"result": None}
 
 
-def batch_update_topics_with_descriptions_by_id(
-    session, final_topics: list, TopicModel, chunk_size: int = 200
-):
+def topic_hash(topic: dict) -> str:
+    """
+    Hash of the representative descriptions of a topic, it changes when the
+    membership of the topic does. The name is left out since the descriptions
+    generated here rename the topic.
     """
-    Batch update topic_name and topic_description for multiple topics in chunks by matching id.
+    content = json.dumps(
+        {
+            key: value
+            for key, value in topic.items()
+            if key.startswith("company_description")
+        },
+        sort_keys=True,
+    )
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+
+def chunk_topics(
+    topics_dicts: typing.List[dict],
+    max_topics: int = TOPIC_DESCRIPTION_CHUNK_SIZE,
+    max_tokens: int = TOPIC_DESCRIPTION_CHUNK_TOKENS,
+) -> typing.List[typing.List[dict]]:
+    """
+    Split the topics into requests small enough for the prompt and for the answer
+    to fit in the completion limit
+    """
+    chunks: typing.List[typing.List[dict]] = []
+    chunk: typing.List[dict] = []
+    chunk_tokens = 0
+
+    for topic in topics_dicts:
+        tokens = count_tokens(str(topic))
+
+        if chunk and (len(chunk) >= max_topics or chunk_tokens + tokens > max_tokens):
+            chunks.append(chunk)
+            chunk = []
+            chunk_tokens = 0
+
+        chunk.append(topic)
+        chunk_tokens += tokens
 
-    :param session: SQLAlchemy session object.
-    :param final_topics: List of dictionaries with 'topic_id', 'topic_title', and 'topic_description'.
-    :param TopicModel: SQLAlchemy ORM model representing the topics table.
-    :param chunk_size: Number of topics to update in each chunk.
+    if chunk:
+        chunks.append(chunk)
+
+    return chunks
+
+
+def describe_topics(
+    topics_dicts: typing.List[dict],
+    concurrency: int = TOPIC_DESCRIPTION_CONCURRENCY,
+    cache: typing.Optional[StateFile] = None,
+) -> typing.List[dict]:
     """
+    Describe the topics in token bounded chunks sent concurrently, reusing the
+    cached description of every topic whose name and top descriptions are unchanged
 
-    # Add other columns as needed
-    # Create a mapping from topic_id to topic_title and topic_description
-    topic_map = {
-        int(item["topic_id"]): {
-            "topic_name": item["new_topic_title"],
-            "topic_description": item["topic_description"],
+    :return: List of dicts with 'topic_id', 'new_topic_title' and 'topic_description'.
+    """
+    cache = cache or StateFile(TOPIC_DESCRIPTION_CACHE_PATH)
+    start = time.time()
+
+    final_topics = []
+    missing = []
+
+    # Curated topics keep their name and description
+    topics_dicts = [
+        topic
+        for topic in topics_dicts
+        if int(topic["topic_id"]) not in EXCLUDED_TOPIC_IDS
+    ]
+
+    for topic in topics_dicts:
+        cached = cache.get(topic_hash(topic))
+
+        if cached:
+            final_topics.append({"topic_id": topic["topic_id"], **cached})
+            continue
+
+        # Only the beginning of long descriptions is sent
+        topic = {
+            key: truncate_tokens(value, MAX_DESCRIPTION_TOKENS)
+            if key.startswith("company_description") and value
+            else value
+            for key, value in topic.items()
         }
+        missing.append(topic)
+
+    hashes = {str(topic["topic_id"]): topic_hash(topic) for topic in topics_dicts}
+    chunks = chunk_topics(missing)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = [executor.submit(get_topic_description, chunk) for chunk in chunks]
+
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                results = future.result().get("result") or []
+            except Exception as e:
+                print(f"Error describing topics: {e}")
+                continue
+
+            described = {}
+            for result in results:
+                key = hashes.get(str(result.get("topic_id")))
+
+                if key is None or not result.get("new_topic_title"):
+                    continue
+
+                final_topics.append(result)
+                described[key] = {
+                    "new_topic_title": result["new_topic_title"],
+                    "topic_description": result.get("topic_description"),
+                }
+
+            cache.update(described)
+
+    print(
+        f"Described {len(final_topics)} of {len(topics_dicts)} topics "
+        f"({len(topics_dicts) - len(missing)} cached, {len(chunks)} requests) "
+        f"in {time.time() - start:.2f}s"
+    )
+
+    return final_topics
+
+
+def batch_update_topics_with_descriptions_by_id(
+    final_topics: list,
+    engine: typing.Optional[sqlalchemy.engine.Engine] = None,
+) -> int:
+    """
+    Batch update topic_name and topic_description for multiple topics by matching id.
+
+    The topics are streamed with one COPY and applied with a single UPDATE ... FROM,
+    instead of one round-trip per topic.
+
+    :param final_topics: List of dictionaries with 'topic_id', 'new_topic_title',
+        and 'topic_description'.
+    :param engine: SQLAlchemy engine, defaults to the shared connection.
+    :return: Number of topics updated.
+    """
+    # Later entries for the same topic win
+    rows = {
+        int(item["topic_id"]): (
+            int(item["topic_id"]),
+            item["new_topic_title"],
+            item["topic_description"],
+        )
         for item in final_topics
     }
 
-    # Query all topics with their id
-    topics = session.query(TopicModel.id).all()
-
-    # Prepare update mappings with id, topic_name, and topic_description
-    update_mappings = []
-    for topic in topics:
-        topic_details = topic_map.get(topic.id)
-        if topic_details:
-            update_mappings.append(
-                {
-                    "id": topic.id,
-                    "topic_name": topic_details["topic_name"],
-                    "topic_description": topic_details["topic_description"],
-                }
-            )
+    start = time.time()
 
-    # Iterate in chunks and perform updates
-    for i in range(0, len(update_mappings), chunk_size):
-        chunk = update_mappings[i : i + chunk_size]
-        try:
-            for mapping in chunk:
-                session.query(TopicModel).filter(TopicModel.id == mapping["id"]).update(
-                    {
-                        "topic_name": mapping["topic_name"],
-                        "topic_description": mapping["topic_description"],
-                    }
-                )
-            session.commit()
-            print(
-                f"Successfully updated {len(chunk)} topics in chunk {i // chunk_size + 1}."
-            )
-        except Exception as e:
-            session.rollback()
-            print(
-                f"An error occurred during bulk update in chunk {i // chunk_size + 1}: {e}"
-            )
+    try:
+        updated = copy_update(
+            "topics",
+            ["id", "topic_name", "topic_description"],
+            rows.values(),
+            key_columns=["id"],
+            engine=engine,
+        )
+    except Exception as e:
+        print(f"An error occurred during bulk update: {e}")
+        return 0
+
+    elapsed = time.time() - start
+    print(
+        f"Updated {updated} of {len(rows)} topics in {elapsed:.2f}s "
+        f"({updated / max(elapsed, 1e-6):.0f} topics/s)"
+    )
+
+    return updated
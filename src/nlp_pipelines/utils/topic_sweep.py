@@ -0,0 +1,213 @@
+import concurrent.futures
+import itertools
+import os
+import tempfile
+import time
+import typing
+
+import numpy as np
+from hdbscan import HDBSCAN
+from sklearn.feature_extraction.text import CountVectorizer
+
+from .bertopic_classifier import build_topic_model
+from .reducer import CACHE_MAX_ENTRIES, CachedReducer
+
+# Worker state, loaded once per process by init_worker
+_embeddings: typing.Optional[np.ndarray] = None
+_descriptions: typing.Optional[typing.List[str]] = None
+
+
+def init_worker(embeddings_path: str, descriptions: typing.List[str]):
+    """
+    Map the shared embedding matrix read-only instead of receiving a pickled copy
+    """
+    global _embeddings, _descriptions
+
+    _embeddings = np.load(embeddings_path, mmap_mode="r")
+    _descriptions = descriptions
+
+
+def fit_config(config: dict) -> dict:
+    """
+    Fit one BERTopic configuration and score it
+    """
+    start = time.time()
+
+    # Each process is one configuration, HDBSCAN must not spawn threads on top
+    topic_model = build_topic_model(
+        calculate_probabilities=False,
+        nr_topics=config["nr_topics"],
+        umap_model=CachedReducer(
+            n_components=config["n_components"], n_jobs=1, mmap=True
+        ),
+    )
+    topic_model.hdbscan_model = HDBSCAN(
+        min_cluster_size=config["min_topic_size"],
+        min_samples=config["min_samples"],
+        metric="euclidean",
+        cluster_selection_method="eom",
+        prediction_data=True,
+        core_dist_n_jobs=1,
+    )
+    topics, _ = topic_model.fit_transform(_descriptions, np.asarray(_embeddings))
+
+    topic_words = [
+        [word for word, _ in topic_model.get_topic(topic_id)]
+        for topic_id in sorted(set(topics) - {-1})
+    ]
+
+    return {
+        **config,
+        **topic_sizes_report(topics),
+        "coherence": topic_coherence(topic_words, _descriptions),
+        "seconds": time.time() - start,
+    }
+
+
+def topic_coherence(
+    topic_words: typing.List[typing.List[str]], documents: typing.List[str]
+) -> float:
+    """
+    Mean normalized pointwise mutual information (NPMI) of the top word pairs of
+    each topic, with document level co-occurrence
+    """
+    vocabulary = sorted({word for words in topic_words for word in words if word})
+    if not vocabulary:
+        return 0.0
+
+    occurrences = CountVectorizer(
+        vocabulary=vocabulary, binary=True, ngram_range=(1, 3)
+    ).fit_transform(documents)
+    occurrences = occurrences.tocsc().astype(np.float64)
+    index = {word: i for i, word in enumerate(vocabulary)}
+
+    count = occurrences.shape[0]
+    scores = []
+
+    for words in topic_words:
+        columns = [index[word] for word in words if word]
+
+        pair_scores = []
+        for a, b in itertools.combinations(columns, 2):
+            p_a = occurrences[:, a].sum() / count
+            p_b = occurrences[:, b].sum() / count
+            p_ab = occurrences[:, a].multiply(occurrences[:, b]).sum() / count
+
+            if p_ab == 0:
+                pair_scores.append(-1.0)
+            elif p_ab == 1:
+                pair_scores.append(1.0)
+            else:
+                pair_scores.append(np.log(p_ab / (p_a * p_b)) / -np.log(p_ab))
+
+        if pair_scores:
+            scores.append(np.mean(pair_scores))
+
+    return float(np.mean(scores)) if scores else 0.0
+
+
+def topic_sizes_report(topics: typing.Sequence[int]) -> dict:
+    """
+    Outlier ratio and how evenly the companies spread over the topics
+    """
+    topics = np.asarray(topics)
+    sizes = np.bincount(topics[topics >= 0]) if (topics >= 0).any() else np.array([])
+    sizes = sizes[sizes > 0]
+
+    report = {
+        "topics": len(sizes),
+        "outlier_ratio": float(np.mean(topics == -1)),
+        "largest_topic_share": float(sizes.max() / len(topics)) if len(sizes) else 0.0,
+        "median_topic_size": float(np.median(sizes)) if len(sizes) else 0.0,
+    }
+
+    # 1.0 when every topic has the same size
+    if len(sizes) > 1:
+        shares = sizes / sizes.sum()
+        report["size_evenness"] = float(
+            -(shares * np.log(shares)).sum() / np.log(len(sizes))
+        )
+    else:
+        report["size_evenness"] = 0.0
+
+    return report
+
+
+def sweep(
+    descriptions: typing.List[str],
+    embeddings: np.ndarray,
+    min_topic_sizes: typing.Sequence[int] = (5, 10, 20, 40),
+    min_samples: typing.Sequence[typing.Optional[int]] = (None,),
+    nr_topics: typing.Sequence[typing.Union[int, str, None]] = ("auto", None),
+    n_components: typing.Sequence[int] = (5,),
+    workers: typing.Optional[int] = None,
+) -> typing.List[dict]:
+    """
+    Fit every combination of the given parameters in a process pool and return
+    their scores, best first.
+
+    The embedding matrix is written once to a memory-mapped file that every worker
+    maps read-only, and each UMAP reduction is computed once and shared through the
+    reduction cache.
+
+    Configurations are ranked by coherence weighted by the share of companies
+    that are not outliers.
+    """
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    configs = [
+        {
+            "min_topic_size": min_topic_size,
+            "min_samples": samples,
+            "nr_topics": topics,
+            "n_components": components,
+        }
+        for min_topic_size, samples, topics, components in itertools.product(
+            min_topic_sizes, min_samples, nr_topics, n_components
+        )
+    ]
+
+    # Reduce up front with every core so the workers only map the cached
+    # coordinates, never the UMAP models. Every reduction of the sweep stays cached.
+    for components in n_components:
+        CachedReducer(
+            n_components=components,
+            cache_models=False,
+            max_entries=max(CACHE_MAX_ENTRIES, len(n_components)),
+        ).fit(embeddings)
+
+    workers = min(workers or os.cpu_count() or 1, len(configs))
+    results = []
+
+    with tempfile.TemporaryDirectory() as directory:
+        embeddings_path = os.path.join(directory, "embeddings.npy")
+        np.save(embeddings_path, embeddings)
+
+        with concurrent.futures.ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=init_worker,
+            initargs=(embeddings_path, descriptions),
+        ) as executor:
+            futures = {executor.submit(fit_config, config): config for config in configs}
+
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    result = future.result()
+                except Exception as e:
+                    print(f"Configuration {futures[future]} failed: {e}")
+                    continue
+
+                print(
+                    f"min_topic_size={result['min_topic_size']} "
+                    f"min_samples={result['min_samples']} "
+                    f"nr_topics={result['nr_topics']} "
+                    f"n_components={result['n_components']}: "
+                    f"{result['topics']} topics, coherence {result['coherence']:.3f}, "
+                    f"{result['outlier_ratio']:.1%} outliers "
+                    f"in {result['seconds']:.1f}s"
+                )
+                results.append(result)
+
+    for result in results:
+        result["score"] = result["coherence"] * (1 - result["outlier_ratio"])
+
+    return sorted(results, key=lambda result: result["score"], reverse=True)
@@ -0,0 +1,135 @@
+import time
+import typing
+
+import sqlalchemy
+
+import src.utils as utils
+from src.utils.bulk_copy import copy_update, copy_upsert
+from src.utils.topics import EXCLUDED_TOPIC_IDS
+
+db = utils.db
+
+
+def allocate_topic_ids(connection, count: int) -> typing.List[int]:
+    """
+    Take `count` new ids from the topics identity, never used by another topic
+    """
+    if count == 0:
+        return []
+
+    return list(
+        connection.execute(
+            sqlalchemy.text(
+                "SELECT nextval(pg_get_serial_sequence('topics', 'id')) "
+                "FROM generate_series(1, :count)"
+            ),
+            {"count": count},
+        ).scalars()
+    )
+
+
+def write_topics(
+    companies_list_of_dicts: typing.List[dict],
+    topic_names: typing.Dict[int, str],
+    refitted: bool = True,
+    topic_ids: typing.Optional[typing.Dict[int, int]] = None,
+    engine: typing.Optional[sqlalchemy.engine.Engine] = None,
+) -> typing.Dict[int, int]:
+    """
+    Persist the topics and the topic of every classified company, with one COPY
+    per table instead of a round-trip per row.
+
+    BERTopic renumbers its topics on every fit, so they are stored under ids of
+    their own: a refit gets new topics, an incremental run reuses `topic_ids` and
+    only inserts the missing topics, so generated titles and descriptions are
+    kept. EXCLUDED_TOPIC_IDS and their companies are never touched.
+
+    After a refit, companies that were not classified in this run lose their
+    stale topic and the topics no longer used are deleted.
+
+    :param companies_list_of_dicts: Companies with "derived_topic_id" and
+        "derived_topic_probability", the ones without are left untouched.
+    :param topic_names: BERTopic id to cleaned topic name, outliers (-1) included.
+    :param refitted: Whether the topic model was fitted from scratch.
+    :param topic_ids: BERTopic id to topics.id of the saved model, ignored after
+        a refit.
+    :param engine: SQLAlchemy engine, defaults to the shared connection.
+    :return: BERTopic id to topics.id, to save with the model.
+    """
+    engine = engine or db.connection
+    start = time.time()
+
+    topic_ids = {} if refitted else dict(topic_ids or {})
+    missing = [
+        topic_id
+        for topic_id in topic_names
+        if topic_id >= 0 and topic_id not in topic_ids
+    ]
+
+    with engine.begin() as connection:
+        topic_ids.update(zip(missing, allocate_topic_ids(connection, len(missing))))
+
+        excluded_companies = set(
+            connection.execute(
+                sqlalchemy.text(
+                    "SELECT id FROM companies WHERE topic_id = ANY(:excluded)"
+                ),
+                {"excluded": EXCLUDED_TOPIC_IDS},
+            ).scalars()
+        )
+
+    copy_upsert(
+        "topics",
+        ["id", "topic_name", "topic_description"],
+        ((topic_ids[topic_id], topic_names[topic_id], None) for topic_id in missing),
+        conflict_columns=["id"],
+        update_columns=[],
+        engine=engine,
+    )
+
+    # Outliers have no topic
+    rows = (
+        (
+            company["id"],
+            topic_ids[company["derived_topic_id"]],
+            company["derived_topic_probability"],
+        )
+        if company["derived_topic_id"] >= 0
+        else (company["id"], None, None)
+        for company in companies_list_of_dicts
+        if "derived_topic_id" in company and company["id"] not in excluded_companies
+    )
+    updated = copy_update(
+        "companies",
+        ["id", "topic_id", "topic_probability"],
+        rows,
+        key_columns=["id"],
+        engine=engine,
+    )
+
+    if refitted:
+        kept = list(topic_ids.values()) + EXCLUDED_TOPIC_IDS
+
+        with engine.begin() as connection:
+            # Every classified company now points to a new topic, the others
+            # (no description, failed embedding) still point to an old one
+            cleared = connection.execute(
+                sqlalchemy.text(
+                    "UPDATE companies SET topic_id = NULL, topic_probability = NULL "
+                    "WHERE topic_id IS NOT NULL AND NOT (topic_id = ANY(:kept))"
+                ),
+                {"kept": kept},
+            ).rowcount
+            connection.execute(
+                sqlalchemy.text("DELETE FROM topics WHERE NOT (id = ANY(:kept))"),
+                {"kept": kept},
+            )
+
+        print(f"Cleared the stale topic of {cleared} unclassified companies")
+
+    print(
+        f"Wrote {len(missing)} topics and {updated} company topics "
+        f"in {time.time() - start:.2f}s"
+    )
+
+    return topic_ids
@@ -0,0 +1,289 @@
+import typing
+
+import numpy as np
+import sqlalchemy
+
+import src.utils as utils
+from src.utils.bulk_copy import copy_upsert
+
+db = utils.db
+
+
+class VectorStore:
+    """
+    Class to persist the description embeddings in Postgres
+
+    Embeddings live in a `halfvec` column with an HNSW index when pgvector is
+    available, otherwise in a packed float32 `bytea` column.
+    """
+
+    def __init__(
+        self,
+        table: str = "company_embeddings",
+        dimensions: typing.Optional[int] = None,
+        engine: typing.Optional[sqlalchemy.engine.Engine] = None,
+    ):
+        """
+        :param dimensions: Size of the embeddings written, None takes the size of
+            the existing table.
+        """
+        self.table = table
+        self.dimensions = dimensions
+        self.engine = engine or db.connection
+        self.kind: typing.Optional[str] = None
+
+    def ensure_schema(self) -> str:
+        """
+        Create the embeddings table if needed and return the storage kind
+        ("halfvec", "vector" or "bytea"). An existing table must hold embeddings
+        of the same size.
+        """
+        if self.kind:
+            return self.kind
+
+        existing = self._existing_column()
+
+        if existing is None:
+            if self.dimensions is None:
+                raise ValueError(
+                    f"{self.table} does not exist, the embedding dimensions are "
+                    "needed to create it"
+                )
+
+            self.kind = self._create_table()
+        else:
+            kind, dimensions = existing
+
+            if self.dimensions is None:
+                self.dimensions = dimensions
+            elif dimensions is not None and dimensions != self.dimensions:
+                raise ValueError(
+                    f"{self.table} holds {dimensions} dimension embeddings, not "
+                    f"{self.dimensions}. Embed with the same EMBEDDING_DIMENSIONS, or "
+                    f"drop {self.table} so it is created again for the new size"
+                )
+
+            self.kind = kind
+
+        print(f"Storing embeddings in {self.table} as {self.kind}")
+        return self.kind
+
+    def _existing_column(
+        self,
+    ) -> typing.Optional[typing.Tuple[str, typing.Optional[int]]]:
+        """
+        Storage kind and dimensions of the existing embedding column, None when
+        the table does not exist
+        """
+        with self.engine.connect() as connection:
+            # The type modifier of vector(n) and halfvec(n) is n
+            row = connection.execute(
+                sqlalchemy.text(
+                    "SELECT t.typname, a.atttypmod FROM pg_attribute a "
+                    "JOIN pg_type t ON t.oid = a.atttypid "
+                    "WHERE a.attrelid = to_regclass(:table) "
+                    "AND a.attname = 'embedding' AND NOT a.attisdropped"
+                ),
+                {"table": self.table},
+            ).first()
+
+            if row is None:
+                return None
+
+            kind, dimensions = row
+
+            # Packed floats have no type modifier, the size is stored per row
+            if kind == "bytea":
+                dimensions = connection.execute(
+                    sqlalchemy.text(f"SELECT dimensions FROM {self.table} LIMIT 1")
+                ).scalar()
+
+        return kind, (dimensions if dimensions and dimensions > 0 else None)
+
+    def _pgvector_version(self) -> typing.Optional[typing.Tuple[int, ...]]:
+        try:
+            with self.engine.begin() as connection:
+                connection.execute(
+                    sqlalchemy.text("CREATE EXTENSION IF NOT EXISTS vector")
+                )
+                version = connection.execute(
+                    sqlalchemy.text(
+                        "SELECT extversion FROM pg_extension WHERE extname = 'vector'"
+                    )
+                ).scalar()
+        except sqlalchemy.exc.DBAPIError as e:
+            print(f"pgvector is not available, falling back to bytea: {e}")
+            return None
+
+        return tuple(int(part) for part in version.split(".")[:2])
+
+    def _create_table(self) -> str:
+        version = self._pgvector_version()
+
+        if version is None:
+            kind = "bytea"
+        elif version >= (0, 7):
+            # halfvec halves the storage and can be indexed up to 4,000 dimensions
+            kind = "halfvec"
+        else:
+            kind = "vector"
+
+        column_type = "bytea" if kind == "bytea" else f"{kind}({self.dimensions})"
+
+        with self.engine.begin() as connection:
+            connection.execute(
+                sqlalchemy.text(
+                    f"""
+                    CREATE TABLE IF NOT EXISTS {self.table} (
+                        company_id text PRIMARY KEY REFERENCES companies(id)
+                            ON DELETE CASCADE ON UPDATE CASCADE,
+                        model text NOT NULL,
+                        dimensions integer NOT NULL,
+                        embedding {column_type} NOT NULL,
+                        updated_at timestamp with time zone DEFAULT now()
+                    )
+                    """
+                )
+            )
+
+            # HNSW on plain vector columns is limited to 2,000 dimensions
+            if kind == "halfvec" or (kind == "vector" and self.dimensions <= 2000):
+                connection.execute(
+                    sqlalchemy.text(
+                        f"CREATE INDEX IF NOT EXISTS {self.table}_embedding_hnsw "
+                        f"ON {self.table} USING hnsw (embedding {kind}_cosine_ops)"
+                    )
+                )
+
+        return kind
+
+    def _format(self, embedding: np.ndarray) -> str:
+        if self.kind == "bytea":
+            return "\\x" + embedding.astype(np.float32).tobytes().hex()
+
+        return "[" + ",".join(map(repr, embedding.astype(np.float32).tolist())) + "]"
+
+    def write(
+        self,
+        company_ids: typing.List[str],
+        embeddings: np.ndarray,
+        model_name: str = "text-embedding-3-large",
+    ) -> int:
+        """
+        Bulk upsert one embedding per company with COPY
+        """
+        self.ensure_schema()
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+
+        rows = (
+            (company_id, model_name, embedding.shape[0], self._format(embedding))
+            for company_id, embedding in zip(company_ids, embeddings)
+        )
+
+        return copy_upsert(
+            self.table,
+            ["company_id", "model", "dimensions", "embedding"],
+            rows,
+            conflict_columns=["company_id"],
+            engine=self.engine,
+        )
+
+    def stored_ids(self, company_ids: typing.List[str]) -> typing.Set[str]:
+        """
+        The given companies that already have a stored embedding
+        """
+        self.ensure_schema()
+
+        with self.engine.connect() as connection:
+            return set(
+                connection.execute(
+                    sqlalchemy.text(
+                        f"SELECT company_id FROM {self.table} "
+                        "WHERE company_id = ANY(:company_ids)"
+                    ),
+                    {"company_ids": list(company_ids)},
+                ).scalars()
+            )
+
+    def read(
+        self, company_ids: typing.Optional[typing.List[str]] = None
+    ) -> typing.Tuple[typing.List[str], np.ndarray]:
+        """
+        Load embeddings straight into a float32 matrix, streaming rows with a
+        server-side cursor
+        """
+        self.ensure_schema()
+
+        column = "embedding" if self.kind == "bytea" else "embedding::vector::real[]"
+        query = f"SELECT company_id, {column} FROM {self.table}"
+        params: typing.Tuple = ()
+
+        if company_ids is not None:
+            query += " WHERE company_id = ANY(%s)"
+            params = (list(company_ids),)
+
+        ids = []
+        vectors = []
+
+        raw_connection = self.engine.raw_connection()
+
+        try:
+            cursor = raw_connection.cursor(name=f"read_{self.table}")
+            cursor.itersize = 5_000
+            cursor.execute(query, params)
+
+            for company_id, embedding in cursor:
+                ids.append(company_id)
+
+                if self.kind == "bytea":
+                    vectors.append(np.frombuffer(embedding, dtype=np.float32))
+                else:
+                    vectors.append(np.asarray(embedding, dtype=np.float32))
+
+            cursor.close()
+        finally:
+            raw_connection.close()
+
+        if not vectors:
+            return ids, np.empty((0, self.dimensions or 0), dtype=np.float32)
+
+        return ids, np.vstack(vectors)
+
+    def similar(
+        self, company_id: str, k: int = 10
+    ) -> typing.List[typing.Tuple[str, float]]:
+        """
+        Return the k companies whose descriptions are closest to `company_id`,
+        computed inside Postgres through the HNSW index
+        """
+        self.ensure_schema()
+
+        if self.kind == "bytea":
+            # No operator on packed floats, score in NumPy instead
+            ids, matrix = self.read()
+            if company_id not in ids:
+                return []
+
+            matrix = matrix / np.linalg.norm(matrix, axis=1, keepdims=True)
+            scores = matrix @ matrix[ids.index(company_id)]
+            order = [i for i in np.argsort(-scores) if ids[i] != company_id][:k]
+            return [(ids[i], float(scores[i])) for i in order]
+
+        with self.engine.connect() as connection:
+            rows = connection.execute(
+                sqlalchemy.text(
+                    f"""
+                    SELECT company_id, 1 - (embedding <=> (
+                        SELECT embedding FROM {self.table} WHERE company_id = :company_id
+                    )) AS score
+                    FROM {self.table}
+                    WHERE company_id <> :company_id
+                    ORDER BY embedding <=> (
+                        SELECT embedding FROM {self.table} WHERE company_id = :company_id
+                    )
+                    LIMIT :k
+                    """
+                ),
+                {"company_id": company_id, "k": k},
+            )
+            return [(row.company_id, float(row.score)) for row in rows]
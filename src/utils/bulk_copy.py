@@ -0,0 +1,270 @@
+import datetime
+import json
+import math
+import time
+import typing
+import uuid
+
+import psycopg2
+from psycopg2 import sql
+
+from . import db
+from .bulk_upsert import bulk_upsert
+
+# Errors caused by the content of a row, see bulk_upsert.ROW_ERRORS
+ROW_ERRORS = (psycopg2.DataError, psycopg2.IntegrityError)
+
+
+def format_csv_value(value: typing.Any) -> str:
+    """
+    Format a value for COPY ... WITH (FORMAT csv), unquoted empty fields are NULL
+    """
+    if value is None:
+        return ""
+
+    if isinstance(value, float) and math.isnan(value):
+        return ""
+
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        value = value.isoformat()
+    elif isinstance(value, (dict, list)):
+        value = json.dumps(value)
+    elif not isinstance(value, str):
+        value = str(value)
+
+    return '"' + value.replace('"', '""') + '"'
+
+
+class CsvStream:
+    """
+    File-like object producing CSV lines from an iterable of rows on demand,
+    so COPY never needs the whole payload in memory
+    """
+
+    def __init__(self, rows: typing.Iterable[typing.Sequence[typing.Any]]):
+        self.rows = iter(rows)
+        self.buffer = ""
+        self.count = 0
+
+    def read(self, size: int = -1) -> str:
+        while size < 0 or len(self.buffer) < size:
+            try:
+                row = next(self.rows)
+            except StopIteration:
+                break
+
+            self.buffer += ",".join(format_csv_value(value) for value in row) + "\n"
+            self.count += 1
+
+        if size < 0:
+            size = len(self.buffer)
+
+        chunk, self.buffer = self.buffer[:size], self.buffer[size:]
+        return chunk
+
+    def readline(self, size: int = -1) -> str:
+        return self.read(size)
+
+
+def copy_upsert(
+    table: str,
+    columns: typing.List[str],
+    rows: typing.Iterable[typing.Sequence[typing.Any]],
+    conflict_columns: typing.List[str],
+    update_columns: typing.Optional[typing.List[str]] = None,
+    engine=None,
+    quarantine: bool = False,
+) -> int:
+    """
+    Stream `rows` into a temporary staging table with COPY, then merge them into
+    `table` with a single INSERT ... ON CONFLICT DO UPDATE.
+
+    :param table: Name of the target table.
+    :param columns: Column names, in the order of the values of each row.
+    :param rows: Iterable of row tuples, consumed lazily.
+    :param conflict_columns: Columns of the unique constraint used for the upsert.
+        Duplicated keys are merged in SQL, the last row wins like in bulk_upsert.
+    :param update_columns: Columns overwritten on conflict, defaults to every column.
+        An empty list keeps the existing rows (ON CONFLICT DO NOTHING).
+    :param engine: SQLAlchemy engine, defaults to the shared connection.
+    :param quarantine: Keep the rows in memory, so when the database rejects one
+        of them the batch is retried through bulk_upsert, which quarantines the
+        bad rows and writes the others.
+    :return: Number of rows inserted or updated.
+    """
+    if update_columns is None:
+        update_columns = columns
+
+    engine = engine or db.connection
+    stage = f"stage_{table}_{uuid.uuid4().hex[:8]}"
+
+    column_list = sql.SQL(", ").join(map(sql.Identifier, columns))
+    conflict_list = sql.SQL(", ").join(map(sql.Identifier, conflict_columns))
+
+    create_stage = sql.SQL(
+        "CREATE TEMP TABLE {stage} (LIKE {table} INCLUDING DEFAULTS) ON COMMIT DROP"
+    ).format(stage=sql.Identifier(stage), table=sql.Identifier(table))
+
+    copy_stage = sql.SQL(
+        "COPY {stage} ({columns}) FROM STDIN WITH (FORMAT csv)"
+    ).format(stage=sql.Identifier(stage), columns=column_list)
+
+    if update_columns:
+        on_conflict = sql.SQL("DO UPDATE SET {updates}").format(
+            updates=sql.SQL(", ").join(
+                sql.SQL("{column} = EXCLUDED.{column}").format(
+                    column=sql.Identifier(column)
+                )
+                for column in update_columns
+            )
+        )
+    else:
+        on_conflict = sql.SQL("DO NOTHING")
+
+    # Rows sit in COPY order in the fresh staging table, so the highest ctid of a
+    # key is its last row
+    merge = sql.SQL(
+        "INSERT INTO {table} ({columns}) "
+        "SELECT DISTINCT ON ({keys}) {columns} FROM {stage} "
+        "ORDER BY {keys}, ctid DESC "
+        "ON CONFLICT ({keys}) {on_conflict}"
+    ).format(
+        table=sql.Identifier(table),
+        columns=column_list,
+        keys=conflict_list,
+        stage=sql.Identifier(stage),
+        on_conflict=on_conflict,
+    )
+
+    if not quarantine:
+        return _copy_and_merge(table, create_stage, copy_stage, merge, rows, engine)
+
+    rows = list(rows)
+
+    try:
+        return _copy_and_merge(table, create_stage, copy_stage, merge, rows, engine)
+    except ROW_ERRORS as e:
+        print(f"COPY into {table} rejected a row, upserting in batches: {e}")
+
+    return bulk_upsert(
+        table,
+        [dict(zip(columns, row)) for row in rows],
+        index_elements=conflict_columns,
+        update_columns=update_columns,
+        engine=engine,
+    )
+
+
+def copy_update(
+    table: str,
+    columns: typing.List[str],
+    rows: typing.Iterable[typing.Sequence[typing.Any]],
+    key_columns: typing.List[str],
+    engine=None,
+) -> int:
+    """
+    Stream `rows` into a temporary staging table with COPY, then apply them to the
+    existing rows of `table` with a single UPDATE ... FROM. Rows whose key is not
+    in `table` are ignored.
+
+    :param table: Name of the target table.
+    :param columns: Column names, in the order of the values of each row.
+    :param rows: Iterable of row tuples, consumed lazily.
+    :param key_columns: Columns matching the staged rows to the existing ones.
+    :param engine: SQLAlchemy engine, defaults to the shared connection.
+    :return: Number of rows updated.
+    """
+    engine = engine or db.connection
+    stage = f"stage_{table}_{uuid.uuid4().hex[:8]}"
+
+    column_list = sql.SQL(", ").join(map(sql.Identifier, columns))
+
+    # Only the staged columns, without the NOT NULL constraints of the others
+    create_stage = sql.SQL(
+        "CREATE TEMP TABLE {stage} ON COMMIT DROP AS "
+        "SELECT {columns} FROM {table} WITH NO DATA"
+    ).format(
+        stage=sql.Identifier(stage), table=sql.Identifier(table), columns=column_list
+    )
+
+    copy_stage = sql.SQL(
+        "COPY {stage} ({columns}) FROM STDIN WITH (FORMAT csv)"
+    ).format(stage=sql.Identifier(stage), columns=column_list)
+
+    update = sql.SQL(
+        "UPDATE {table} AS target SET {updates} FROM {stage} AS stage WHERE {keys}"
+    ).format(
+        table=sql.Identifier(table),
+        stage=sql.Identifier(stage),
+        updates=sql.SQL(", ").join(
+            sql.SQL("{column} = stage.{column}").format(column=sql.Identifier(column))
+            for column in columns
+            if column not in key_columns
+        ),
+        keys=sql.SQL(" AND ").join(
+            sql.SQL("target.{column} = stage.{column}").format(
+                column=sql.Identifier(column)
+            )
+            for column in key_columns
+        ),
+    )
+
+    return _copy_and_merge(table, create_stage, copy_stage, update, rows, engine)
+
+
+def _copy_and_merge(table, create_stage, copy_stage, merge, rows, engine) -> int:
+    start = time.time()
+    stream = CsvStream(rows)
+    raw_connection = engine.raw_connection()
+
+    try:
+        cursor = raw_connection.cursor()
+        cursor.execute(create_stage)
+        cursor.copy_expert(copy_stage, stream)
+        cursor.execute(merge)
+        merged = cursor.rowcount
+        raw_connection.commit()
+    except Exception:
+        raw_connection.rollback()
+        raise
+    finally:
+        raw_connection.close()
+
+    print(
+        f"Copied {stream.count} rows into {table} ({merged} merged) "
+        f"in {time.time() - start:.2f}s"
+    )
+
+    return merged
+
+
+HARMONIC_DATA_COLUMNS = ["company_id", "type", "source", "date", "value"]
+HARMONIC_DATA_KEYS = ["company_id", "type", "source", "date"]
+
+
+def copy_upsert_harmonic_data(data_points: typing.Iterable[dict], engine=None) -> int:
+    """
+    Bulk load (company, type, source, date) -> value points into harmonic_data,
+    incomplete points are skipped and rejected ones quarantined
+    """
+    rows = (
+        tuple(point.get(column) for column in HARMONIC_DATA_COLUMNS)
+        for point in data_points
+    )
+    rows = (
+        row
+        for row in rows
+        if not any(
+            value is None or (isinstance(value, float) and math.isnan(value))
+            for value in row
+        )
+    )
+
+    return copy_upsert(
+        "harmonic_data",
+        HARMONIC_DATA_COLUMNS,
+        rows,
+        conflict_columns=HARMONIC_DATA_KEYS,
+        engine=engine,
+        quarantine=True,
+    )
@@ -0,0 +1,140 @@
+import json
+import os
+import threading
+import time
+import typing
+
+import sqlalchemy
+from sqlalchemy.dialects import postgresql
+
+from . import db
+
+# Postgres accepts at most 65,535 bound parameters per statement
+MAX_PARAMETERS = 65_535
+
+# Rows rejected by the database are appended here as JSON lines
+QUARANTINE_FILE = os.environ.get(
+    "BULK_UPSERT_QUARANTINE_FILE", ".state/quarantine.jsonl"
+)
+
+# Errors caused by the content of a row, the other rows of its batch can still
+# be written. Anything else (connection lost, unknown column) fails every row.
+ROW_ERRORS = (sqlalchemy.exc.DataError, sqlalchemy.exc.IntegrityError)
+
+quarantine_lock = threading.Lock()
+
+
+def dedupe(
+    rows: typing.Iterable[dict], index_elements: typing.Sequence[str]
+) -> typing.List[dict]:
+    """
+    Keep the last row of every key, Postgres refuses to upsert a key twice in
+    one statement
+    """
+    return list(
+        {tuple(row[key] for key in index_elements): row for row in rows}.values()
+    )
+
+
+def quarantine(table_name: str, row: dict, error: Exception):
+    with quarantine_lock:
+        os.makedirs(os.path.dirname(QUARANTINE_FILE) or ".", exist_ok=True)
+
+        with open(QUARANTINE_FILE, "a") as f:
+            f.write(
+                json.dumps(
+                    {
+                        "table": table_name,
+                        "error": str(getattr(error, "orig", error)).strip(),
+                        "row": row,
+                    },
+                    default=str,
+                )
+                + "\n"
+            )
+
+
+def bulk_upsert(
+    table_name: str,
+    rows: typing.Iterable[dict],
+    index_elements: typing.Sequence[str] = ("id",),
+    update_columns: typing.Optional[typing.List[str]] = None,
+    batch_size: int = 1_000,
+    engine=None,
+) -> int:
+    """
+    INSERT ... ON CONFLICT upsert of dict rows sharing the same keys, committed
+    batch by batch.
+
+    A batch rejected because of its data is split in halves until the bad rows
+    are isolated, they are quarantined in QUARANTINE_FILE and the rest is written.
+    Rows are written sorted by key, so parallel callers cannot deadlock.
+
+    :param table_name: Name of the target table.
+    :param rows: Rows to upsert, duplicated keys are merged, the last row wins
+        like in copy_upsert.
+    :param index_elements: Columns of the unique constraint used for the upsert.
+    :param update_columns: Columns overwritten on conflict, defaults to every
+        column of the rows. An empty list inserts new rows only (DO NOTHING).
+    :param batch_size: Rows per statement, lowered to stay under MAX_PARAMETERS.
+    :param engine: SQLAlchemy engine, defaults to the shared one.
+    :return: Number of rows written (including rows skipped by DO NOTHING).
+    """
+    rows = dedupe(rows, index_elements)
+
+    if not rows:
+        return 0
+
+    # Concurrent upserts of overlapping keys lock them in the same order, instead
+    # of deadlocking when each one sends them in its own order
+    rows.sort(key=lambda row: tuple(row[key] for key in index_elements))
+
+    engine = engine or db.connection
+    table = db.schema.metadata.tables[table_name]
+
+    columns = list(rows[0].keys())
+    if update_columns is None:
+        update_columns = columns
+
+    batch_size = max(1, min(batch_size, MAX_PARAMETERS // len(columns)))
+
+    def execute(batch: typing.List[dict]):
+        upsert = postgresql.insert(table).values(batch)
+
+        if update_columns:
+            upsert = upsert.on_conflict_do_update(
+                index_elements=list(index_elements),
+                set_={key: upsert.excluded[key] for key in update_columns},
+            )
+        else:
+            upsert = upsert.on_conflict_do_nothing(index_elements=list(index_elements))
+
+        with engine.begin() as connection:
+            connection.execute(upsert)
+
+    def write(batch: typing.List[dict]) -> int:
+        try:
+            execute(batch)
+            return len(batch)
+        except ROW_ERRORS as e:
+            if len(batch) == 1:
+                print(f"Quarantined a row of {table_name}: {e.orig}")
+                quarantine(table_name, batch[0], e)
+                return 0
+
+            middle = len(batch) // 2
+            return write(batch[:middle]) + write(batch[middle:])
+
+    started_at = time.time()
+    written = sum(
+        write(rows[i : i + batch_size]) for i in range(0, len(rows), batch_size)
+    )
+    elapsed = time.time() - started_at
+
+    print(
+        f"Upserted {written} rows into {table_name} in {elapsed:.2f}s "
+        f"({written / max(elapsed, 1e-6):.0f} rows/s)"
+        + (f", {len(rows) - written} quarantined" if written < len(rows) else "")
+    )
+
+    return written
@@ -1,4 +1,7 @@
+import hashlib
 import os
+import pickle
+import threading
 
 import sqlalchemy
 from sqlalchemy.ext.automap import automap_base
@@ -10,15 +13,130 @@ load_dotenv()
 # Get database URL from environment variables
 DATABASE_URL = os.environ.get("DATABASE_URL")
 
-# Ensure the database URL is set
-if not DATABASE_URL:
-    raise ValueError("Could not find DATABASE_URL in environment variables")
+# Reflected metadata is pickled here, keyed by a fingerprint of the schema
+SCHEMA_CACHE_DIR = os.environ.get("SCHEMA_CACHE_DIR", ".cache/schema")
 
-# Connect to the database
-connection = sqlalchemy.create_engine(DATABASE_URL, echo=False)
+# Everything below is created on first use, importing this module does not touch
+# the database. `db.connection`, `db.schema` and `db.session` keep working as
+# before through the module level __getattr__.
+_lock = threading.RLock()
+_connection = None
+_schema = None
+_session = None
 
-# Reflect the database schema
-schema = automap_base()
-schema.prepare(autoload_with=connection, engine=connection)
+SCHEMA_FINGERPRINT_QUERY = """
+SELECT md5(string_agg(item, ',' ORDER BY item)) FROM (
+    SELECT concat_ws(':', table_name, column_name, data_type, is_nullable,
+                     column_default) AS item
+    FROM information_schema.columns
+    WHERE table_schema = current_schema()
+    UNION ALL
+    SELECT concat_ws(':', tc.table_name, tc.constraint_name, tc.constraint_type,
+                     kcu.column_name, ccu.table_name, ccu.column_name)
+    FROM information_schema.table_constraints tc
+    LEFT JOIN information_schema.key_column_usage kcu
+        ON kcu.constraint_name = tc.constraint_name
+        AND kcu.table_schema = tc.table_schema
+    LEFT JOIN information_schema.constraint_column_usage ccu
+        ON ccu.constraint_name = tc.constraint_name
+        AND ccu.table_schema = tc.table_schema
+    WHERE tc.table_schema = current_schema()
+) items
+"""
 
-session = sqlalchemy.orm.Session(connection)
+
+def get_connection() -> sqlalchemy.engine.Engine:
+    """
+    Shared engine, created on first use
+    """
+    global _connection
+
+    with _lock:
+        if _connection is None:
+            # Ensure the database URL is set
+            if not DATABASE_URL:
+                raise ValueError("Could not find DATABASE_URL in environment variables")
+
+            # Connect to the database
+            _connection = sqlalchemy.create_engine(DATABASE_URL, echo=False)
+
+        return _connection
+
+
+def schema_fingerprint() -> str:
+    with get_connection().connect() as connection:
+        fingerprint = connection.execute(
+            sqlalchemy.text(SCHEMA_FINGERPRINT_QUERY)
+        ).scalar()
+
+    key = f"{DATABASE_URL}:{sqlalchemy.__version__}:{fingerprint}"
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()[:16]
+
+
+def load_metadata() -> sqlalchemy.MetaData:
+    """
+    Reflected metadata, read from the pickle cache while the schema fingerprint
+    is unchanged, so only one small query runs instead of a full reflection
+    """
+    path = os.path.join(SCHEMA_CACHE_DIR, f"metadata_{schema_fingerprint()}.pickle")
+
+    if os.path.exists(path):
+        try:
+            with open(path, "rb") as f:
+                return pickle.load(f)
+        except Exception as e:
+            print(f"Could not read the schema cache, reflecting again: {e}")
+
+    metadata = sqlalchemy.MetaData()
+    metadata.reflect(bind=get_connection())
+
+    os.makedirs(SCHEMA_CACHE_DIR, exist_ok=True)
+
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        pickle.dump(metadata, f)
+    os.replace(tmp_path, path)
+
+    return metadata
+
+
+def get_schema():
+    """
+    Automapped classes of the database tables, created on first use
+    """
+    global _schema
+
+    with _lock:
+        if _schema is None:
+            # Reflect the database schema
+            schema = automap_base(metadata=load_metadata())
+            schema.prepare()
+            _schema = schema
+
+        return _schema
+
+
+def get_session() -> sqlalchemy.orm.Session:
+    """
+    Shared session, created on first use
+    """
+    global _session
+
+    with _lock:
+        if _session is None:
+            _session = sqlalchemy.orm.Session(get_connection())
+
+        return _session
+
+
+def __getattr__(name: str):
+    if name == "connection":
+        return get_connection()
+
+    if name == "schema":
+        return get_schema()
+
+    if name == "session":
+        return get_session()
+
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
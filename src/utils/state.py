@@ -0,0 +1,58 @@
+import json
+import os
+import threading
+import typing
+
+
+class StateFile:
+    """
+    Small JSON document persisted on disk to keep progress (cursors, checkpoints)
+    between runs. Writes are atomic and safe to call from several threads.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+        self.state: typing.Dict[str, typing.Any] = {}
+
+        if os.path.exists(path):
+            with open(path) as f:
+                self.state = json.load(f)
+
+    def get(self, key: str, default: typing.Any = None) -> typing.Any:
+        with self.lock:
+            return self.state.get(key, default)
+
+    def set(self, key: str, value: typing.Any):
+        with self.lock:
+            self.state[key] = value
+            self._write()
+
+    def update(self, values: typing.Dict[str, typing.Any]):
+        """
+        Set several keys with a single write
+        """
+        if not values:
+            return
+
+        with self.lock:
+            self.state.update(values)
+            self._write()
+
+    def delete(self, key: str):
+        with self.lock:
+            if self.state.pop(key, None) is not None:
+                self._write()
+
+    def _write(self):
+        directory = os.path.dirname(self.path)
+
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        # Write next to the target then rename, a crash never leaves a truncated file
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.state, f, indent=2, default=str)
+
+        os.replace(tmp_path, self.path)
@@ -0,0 +1,9 @@
+import os
+
+# Topics curated by hand, their companies are left out of the data collection.
+# The topic model never renames, deletes or reassigns them.
+EXCLUDED_TOPIC_IDS = [
+    int(topic_id)
+    for topic_id in os.environ.get("EXCLUDED_TOPIC_IDS", "14").split(",")
+    if topic_id.strip()
+]
@@ -0,0 +1,187 @@
+import os
+import queue
+import threading
+import time
+import typing
+
+from . import db
+from .bulk_upsert import bulk_upsert
+
+# Buffered rows (all tables) that trigger a write
+MAX_ROWS = int(os.environ.get("WRITE_BEHIND_MAX_ROWS", 5_000))
+
+# Age in seconds of the oldest buffered row that triggers a write
+MAX_SECONDS = float(os.environ.get("WRITE_BEHIND_MAX_SECONDS", 10))
+
+# Writes a list of rows of one table, e.g. copy_upsert_harmonic_data
+Handler = typing.Callable[[typing.List[dict], typing.Any], typing.Any]
+
+
+def upsert_handler(
+    table_name: str,
+    index_elements: typing.Sequence[str] = ("id",),
+    update_columns: typing.Optional[typing.List[str]] = None,
+) -> Handler:
+    """
+    Handler upserting rows with bulk_upsert, the last row of a key wins
+    """
+
+    def write(rows: typing.List[dict], engine):
+        bulk_upsert(table_name, rows, index_elements, update_columns, engine=engine)
+
+    return write
+
+
+class WriteBehindWriter:
+    """
+    Collectors push rows to a bounded queue and keep fetching, while a dedicated
+    thread coalesces them per table and writes them in large batches, once enough
+    rows are buffered or the oldest one has waited `max_seconds`.
+
+    Tables are always written in the order of `handlers`, so listing parents
+    before their children (organizations before repositories) keeps foreign keys
+    satisfied.
+
+        with WriteBehindWriter({"harmonic_data": copy_upsert}) as writer:
+            writer.put("harmonic_data", rows)
+    """
+
+    def __init__(
+        self,
+        handlers: typing.Dict[str, Handler],
+        max_rows: int = MAX_ROWS,
+        max_seconds: float = MAX_SECONDS,
+        max_queued: int = 1_000,
+        engine=None,
+    ):
+        """
+        :param handlers: Table name to a function writing a list of rows, in
+            the order the tables are written.
+        :param max_rows: Buffered rows (all tables) that trigger a write.
+        :param max_seconds: Age of the oldest buffered row that triggers a write.
+        :param max_queued: Pushes waiting for the writer before put() blocks.
+        :param engine: SQLAlchemy engine given to the handlers.
+        """
+        self.handlers = handlers
+        self.max_rows = max_rows
+        self.max_seconds = max_seconds
+        self.engine = engine or db.connection
+
+        self.queue: queue.Queue = queue.Queue(maxsize=max_queued)
+        self.buffers: typing.Dict[str, typing.List[dict]] = {
+            table: [] for table in handlers
+        }
+        self.buffered = 0
+        self.oldest: typing.Optional[float] = None
+
+        # Whether every write since the last callback succeeded
+        self.healthy = True
+
+        self.written = 0
+        self.writes = 0
+        self.failed = 0
+        self.started_at = time.time()
+
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def __enter__(self) -> "WriteBehindWriter":
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def put(self, table: str, rows: typing.Iterable[dict]):
+        """
+        Queue rows for `table`, blocks while the queue is full
+        """
+        if table not in self.handlers:
+            raise ValueError(f"No handler for table {table}")
+
+        rows = list(rows)
+
+        if rows:
+            self._put(("rows", table, rows))
+
+    def call(self, callback: typing.Callable[[], typing.Any]):
+        """
+        Write everything queued so far, then run `callback` if it was all written,
+        e.g. to record progress only once the rows are in the database
+        """
+        self._put(("call", None, callback))
+
+    def close(self):
+        """
+        Write the remaining rows and stop the writer thread
+        """
+        if self.thread.is_alive():
+            self.queue.put(("stop", None, None))
+            self.thread.join()
+
+        elapsed = time.time() - self.started_at
+        print(
+            f"Wrote {self.written} rows in {self.writes} writes "
+            f"({self.failed} rows failed) in {elapsed:.2f}s"
+        )
+
+    def _put(self, item):
+        if not self.thread.is_alive():
+            raise RuntimeError("The writer thread has stopped")
+
+        self.queue.put(item)
+
+    def _run(self):
+        while True:
+            timeout = None
+            if self.oldest is not None:
+                timeout = max(0.0, self.oldest + self.max_seconds - time.monotonic())
+
+            try:
+                kind, table, payload = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                self._flush()
+                continue
+
+            if kind == "rows":
+                self.buffers[table].extend(payload)
+                self.buffered += len(payload)
+
+                if self.oldest is None:
+                    self.oldest = time.monotonic()
+
+                if self.buffered >= self.max_rows:
+                    self._flush()
+
+            elif kind == "call":
+                self._flush()
+
+                if self.healthy:
+                    try:
+                        payload()
+                    except Exception as e:
+                        print(f"Writer callback failed: {e}")
+
+                self.healthy = True
+
+            else:
+                self._flush()
+                return
+
+    def _flush(self):
+        for table, rows in self.buffers.items():
+            if not rows:
+                continue
+
+            try:
+                self.handlers[table](rows, self.engine)
+                self.written += len(rows)
+                self.writes += 1
+            except Exception as e:
+                print(f"Error writing {len(rows)} rows to {table}: {e}")
+                self.failed += len(rows)
+                self.healthy = False
+
+            self.buffers[table] = []
+
+        self.buffered = 0
+        self.oldest = None